@@ -67,6 +67,10 @@ def configure(repl):
     repl.enable_fuzzy_completion = False
     repl.enable_dictionary_completion = False
 
+    # Import Jedi in the background after the first prompt is drawn, so that
+    # the first completion is fast.
+    repl.enable_jedi_warm_up = True
+
     # Vi mode.
     repl.vi_mode = False
 
@@ -79,6 +83,42 @@ def configure(repl):
     # Don't insert a blank line after the output.
     repl.insert_blank_line_after_output = False
 
+    # Run statements in a worker thread, and move them to the background
+    # (like %bg) when they take longer than this many seconds. (None or float.)
+    repl.auto_background_after = None
+
+    # Stop writing a result after this many lines or characters. The rest
+    # can be displayed with %more. (None or 0 for no limit.)
+    repl.max_output_lines = 2000
+    repl.max_output_chars = 1000000
+
+    # Open results that are taller than the terminal in a pager.
+    repl.enable_pager = True
+
+    # Limits of the results that are kept in `_N`. Beyond them, the least
+    # recently used results are evicted. (None for no limit, see `%outmem`.)
+    repl.output_history.max_entries = 1000
+    repl.output_history.max_bytes = 512 * 1024 * 1024
+
+    # Budget for formatting one result: the number of container items and
+    # of characters. Past it, only the head and tail of containers and
+    # strings are shown.
+    repl.formatter.max_items = 10000
+    repl.formatter.max_chars = 1000000
+
+    # Evaluate properties (and other descriptors) of objects that are
+    # displayed with their attributes. They can run queries or network calls,
+    # so by default, they are shown as not evaluated. (See `%pp -p`.)
+    repl.formatter.evaluate_properties = False
+
+    # Formatter for results of some type and its subclasses. (Packages can
+    # register formatters with a 'ptpython.formatters' entry point too.)
+    """
+    @repl.formatter.register(decimal.Decimal)
+    def _(o, formatter, indent):
+        return [("class:pygments.number", str(o))]
+    """
+
     # History Search.
     # When True, going back in history will filter the history on the records
     # starting with the current input. (Like readline.)
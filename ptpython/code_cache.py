@@ -0,0 +1,115 @@
+"""
+Cache for compiled code objects.
+
+The validator compiles the input on every validation, and when the input is
+accepted, the REPL compiles exactly the same text again. Sharing one cache
+between the two (and `%run`) means that every source is compiled only once.
+"""
+import ast
+import threading
+from collections import OrderedDict, namedtuple
+from typing import Any, Optional, Tuple
+
+__all__ = ["CodeCache", "LAST_EXPR"]
+
+#: Compile mode that returns a `(statements, expression)` tuple of code
+#: objects. The expression is the trailing expression statement of the input,
+#: if there is one (like IPython's "last_expr" mode). Either can be `None`.
+LAST_EXPR = "last_expr"
+
+CacheInfo = namedtuple("CacheInfo", ("hits", "misses", "maxsize", "currsize"))
+
+
+class CodeCache:
+    """
+    Bounded LRU cache of code objects, keyed by the source, filename, mode and
+    compiler flags.
+
+    :param maxsize: Maximum amount of code objects to keep.
+    """
+
+    def __init__(self, maxsize: int = 256) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache: "OrderedDict[Tuple[str, str, str, int], Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def compile(self, source: str, filename: str, mode: str, flags: int = 0) -> Any:
+        """
+        Like the `compile` builtin (with `dont_inherit=True`), but return a
+        cached code object if this source was compiled before.
+        `SyntaxError` and friends propagate, and are never cached.
+        """
+        key = (source, filename, mode, flags)
+
+        with self._lock:
+            try:
+                code = self._cache[key]
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._cache.move_to_end(key)
+                return code
+
+        if mode == LAST_EXPR:
+            code = _compile_last_expr(source, filename, flags)
+        else:
+            code = compile(source, filename, mode, flags=flags, dont_inherit=True)
+
+        with self._lock:
+            self._cache[key] = code
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return code
+
+    def cache_info(self) -> CacheInfo:
+        " Report cache statistics, like `functools.lru_cache`. "
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._cache))
+
+    def clear(self) -> None:
+        " Clear the cache and the statistics. "
+        with self._lock:
+            self._cache.clear()
+            self.hits = self.misses = 0
+
+
+def _compile_last_expr(source: str, filename: str, flags: int):
+    """
+    Parse the source only once, and compile the statements and the trailing
+    expression from the same tree.
+    """
+    tree = compile(
+        source, filename, "exec", flags=flags | ast.PyCF_ONLY_AST, dont_inherit=True
+    )
+    statements, expression = _split_last_expression(tree)
+
+    if statements is not None:
+        statements = compile(
+            statements, filename, "exec", flags=flags, dont_inherit=True
+        )
+    if expression is not None:
+        expression = compile(
+            expression, filename, "eval", flags=flags, dont_inherit=True
+        )
+    return statements, expression
+
+
+def _split_last_expression(tree: ast.Module):
+    """
+    Split a parsed module in the statements to `exec` and the trailing
+    expression to `eval`, like IPython's "last_expr" mode. Return a
+    `(module, expression)` tuple, where either of them can be `None`.
+    """
+    statements = tree.body
+    expression: Optional[ast.Expression] = None
+    if statements:
+        last = statements[-1]
+        if isinstance(last, ast.Expr):
+            statements = statements[:-1]
+            expression = ast.Expression(body=last.value)
+
+    if not statements:
+        return None, expression
+    return ast.Module(body=statements, type_ignores=[]), expression
@@ -1,7 +1,11 @@
 import ast
+import builtins
+import inspect
 import keyword
 import re
-from typing import TYPE_CHECKING, Any, Dict, Iterable, List
+import types
+from collections import ChainMap
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Mapping, Optional, Tuple
 
 from prompt_toolkit.completion import (
     CompleteEvent,
@@ -17,7 +21,7 @@ from prompt_toolkit.contrib.regular_languages.lexer import GrammarLexer
 from prompt_toolkit.lexers import PygmentsLexer, SimpleLexer
 from pygments.lexers import BashLexer, PythonLexer
 
-from ptpython.utils import get_jedi_script_from_document
+from ptpython.utils import get_jedi_script_from_document, has_unclosed_brackets
 
 from .magic import MagicCompleter
 
@@ -26,20 +30,62 @@ if TYPE_CHECKING:
 
 __all__ = ["PythonCompleter"]
 
+# The identifier that's being typed.
+_identifier_before_cursor_re = re.compile(r"\w*$")
+
+# A name, or a dotted name and a dot, before the identifier that's being typed.
+# (Not the attribute of another expression, like a call.)
+_dotted_name_before_cursor_re = re.compile(
+    r"""(?<![\w.)\]}'"])(?P<dotted_name>([^\W\d]\w*\.)*)$"""
+)
+
+# Statements that bind names, and comments. Jedi knows about names that
+# don't exist in the namespace yet. (Multiline input is left to Jedi too.)
+_needs_jedi_re = re.compile(
+    r"\b(import|from|def|class|lambda|for|with|as|except|global|nonlocal)\b"
+    r"|[\n;#@]|:="
+)
+
 
 class PythonCompleter(Completer):
     """
     Completer for Python code.
     """
 
-    def __init__(self, get_globals, get_locals, get_enable_dictionary_completion):
+    def __init__(
+        self,
+        get_globals,
+        get_locals,
+        get_enable_dictionary_completion,
+        get_kernel=None,
+        get_namespace_version=None,
+    ):
         super().__init__()
 
         self.get_globals = get_globals
         self.get_locals = get_locals
         self.get_enable_dictionary_completion = get_enable_dictionary_completion
+        self.get_kernel = get_kernel or (lambda: None)
+
+        # Changes whenever code runs that can change the namespace. (Like the
+        # statement index.)
+        self.get_namespace_version = get_namespace_version or (lambda: None)
 
-        self.dictionary_completer = DictionaryCompleter(get_globals, get_locals)
+        # (key, [(name, style)]) of the last completion.
+        self._completion_cache: Optional[Tuple[tuple, List[Tuple[str, str]]]] = None
+
+        # (namespace key, [(name, style)]) of all the names in the namespace.
+        self._names_cache: Optional[Tuple[tuple, List[Tuple[str, str]]]] = None
+
+        # (namespace version, {class: [(name, style)]}) for `dir()`.
+        self._attribute_names_cache: Tuple[Any, Dict[type, List[Tuple[str, str]]]] = (
+            None,
+            {},
+        )
+
+        self.dictionary_completer = DictionaryCompleter(
+            get_globals, get_locals, self.get_namespace_version
+        )
 
         self._path_completer_cache = None
         self._path_completer_grammar_cache = None
@@ -129,6 +175,14 @@ class PythonCompleter(Completer):
         """
         Get Python completions.
         """
+        # In kernel mode, the namespace lives in the kernel process.
+        kernel = self.get_kernel()
+        if kernel is not None:
+            yield from kernel.get_completions(
+                document, complete_event, self.get_enable_dictionary_completion()
+            )
+            return
+
         # Do dictionary key completions.
         if self.get_enable_dictionary_completion():
             has_dict_completions = False
@@ -154,61 +208,212 @@ class PythonCompleter(Completer):
         if self._path_completer_grammar.match(document.text_before_cursor):
             return
 
-        # Do Jedi Python completions.
+        # Do Python completions: from the live namespace for simple (dotted)
+        # names, otherwise from Jedi.
         if complete_event.completion_requested or self._complete_python_while_typing(
             document
         ):
-            script = get_jedi_script_from_document(
-                document, self.get_locals(), self.get_globals()
+            match = _identifier_before_cursor_re.search(document.text_before_cursor)
+            word = match.group() if match else ""
+            word_lower = word.lower()
+
+            for name, style in self._get_python_completions(document, len(word)):
+                # (Jedi matches case-insensitive too.)
+                if name.lower().startswith(word_lower):
+                    yield Completion(name, -len(word), display=name, style=style)
+
+    def _get_python_completions(
+        self, document: Document, word_length: int
+    ) -> List[Tuple[str, str]]:
+        """
+        Return `(name, style)` for all the completions at the start of the
+        identifier before the cursor. (That's `word_length` characters.)
+
+        The result is cached for the text around that identifier and the
+        version of the namespace, so that while the identifier is being typed,
+        the completions are only narrowed down.
+        """
+        text_before = document.text_before_cursor[
+            : len(document.text_before_cursor) - word_length
+        ]
+        locals = self.get_locals()
+        globals = self.get_globals()
+        version = self.get_namespace_version()
+        key = (
+            text_before,
+            document.text_after_cursor,
+            version,
+            id(locals),
+            len(locals),
+            id(globals),
+            len(globals),
+        )
+
+        # (Completions run in a thread, so read and replace the caches as a
+        # whole.)
+        cache = self._completion_cache
+        if cache is not None and cache[0] == key:
+            return cache[1]
+
+        if self._attribute_names_cache[0] != version:
+            self._attribute_names_cache = (version, {})
+
+        completions = self._get_namespace_completions(
+            text_before, locals, globals, key[2:]
+        )
+        if completions is None:
+            completions = self._get_jedi_completions(
+                text_before, document.text_after_cursor, locals, globals
             )
 
-            if script:
-                try:
-                    completions = script.completions()
-                except TypeError:
-                    # Issue #9: bad syntax causes completions() to fail in jedi.
-                    # https://github.com/jonathanslenders/python-prompt-toolkit/issues/9
-                    pass
-                except UnicodeDecodeError:
-                    # Issue #43: UnicodeDecodeError on OpenBSD
-                    # https://github.com/jonathanslenders/python-prompt-toolkit/issues/43
-                    pass
-                except AttributeError:
-                    # Jedi issue #513: https://github.com/davidhalter/jedi/issues/513
-                    pass
-                except ValueError:
-                    # Jedi issue: "ValueError: invalid \x escape"
-                    pass
-                except KeyError:
-                    # Jedi issue: "KeyError: u'a_lambda'."
-                    # https://github.com/jonathanslenders/ptpython/issues/89
-                    pass
-                except IOError:
-                    # Jedi issue: "IOError: No such file or directory."
-                    # https://github.com/jonathanslenders/ptpython/issues/71
-                    pass
-                except AssertionError:
-                    # In jedi.parser.__init__.py: 227, in remove_last_newline,
-                    # the assertion "newline.value.endswith('\n')" can fail.
-                    pass
-                except SystemError:
-                    # In jedi.api.helpers.py: 144, in get_stack_at_position
-                    # raise SystemError("This really shouldn't happen. There's a bug in Jedi.")
-                    pass
-                except NotImplementedError:
-                    # See: https://github.com/jonathanslenders/ptpython/issues/223
-                    pass
-                except Exception:
-                    # Supress all other Jedi exceptions.
-                    pass
-                else:
-                    for c in completions:
-                        yield Completion(
-                            c.name_with_symbols,
-                            len(c.complete) - len(c.name_with_symbols),
-                            display=c.name_with_symbols,
-                            style=_get_style_for_name(c.name_with_symbols),
-                        )
+        self._completion_cache = (key, completions)
+        return completions
+
+    def _get_namespace_completions(
+        self,
+        text_before: str,
+        locals: Dict[str, Any],
+        globals: Dict[str, Any],
+        namespace_key: tuple,
+    ) -> Optional[List[Tuple[str, str]]]:
+        """
+        Complete a name or a dotted name, like `obj.attr.`, by looking at the
+        live objects in the namespace. Return `None` when this needs Jedi: for
+        other expressions, for names that aren't known yet, and for attributes
+        that aren't plain values, so that nothing gets evaluated.
+        """
+        match = _dotted_name_before_cursor_re.search(text_before)
+        if match is None or _needs_jedi_re.search(text_before):
+            return None
+        dotted_name = match.group("dotted_name")
+
+        if not dotted_name:
+            # A bare name. (Inside function calls, Jedi completes the
+            # keyword arguments.)
+            if has_unclosed_brackets(text_before):
+                return None
+            cache = self._names_cache
+            if cache is not None and cache[0] == namespace_key:
+                return cache[1]
+            names = set(locals)
+            names.update(globals, _builtin_names, keyword.kwlist)
+            completions = _with_styles(sorted(names, key=_completion_sort_key))
+            self._names_cache = (namespace_key, completions)
+            return completions
+
+        # Look up the object, without calling properties or `__getattr__`.
+        root, *attributes = dotted_name[:-1].split(".")
+        for namespace in (locals, globals, builtins.__dict__):
+            if root in namespace:
+                obj = namespace[root]
+                break
+        else:
+            return None
+        try:
+            for attribute in attributes:
+                obj = inspect.getattr_static(obj, attribute)
+                if not isinstance(obj, (type, types.ModuleType)) and hasattr(
+                    type(obj), "__get__"
+                ):
+                    return None  # Descriptor, like a property or a method.
+            return self._get_attribute_names(obj)
+        except Exception:
+            return None
+
+    def _get_attribute_names(self, obj: object) -> List[Tuple[str, str]]:
+        """
+        `dir(obj)` as `(name, style)`. The attributes of a class are cached
+        until the namespace changes, and combined with the `__dict__` of the
+        instance.
+        """
+        if isinstance(obj, type):
+            cls = obj
+        elif (
+            isinstance(obj, types.ModuleType) or type(obj).__dir__ is not object.__dir__
+        ):
+            # (Modules, and objects that compute their own attributes, like
+            # the column names of a pandas `DataFrame`.)
+            return _with_styles(sorted(set(dir(obj)), key=_completion_sort_key))
+        else:
+            cls = type(obj)
+
+        cache = self._attribute_names_cache[1]
+        names = cache.get(cls)
+        if names is None:
+            names = cache[cls] = _with_styles(
+                sorted(set(dir(cls)), key=_completion_sort_key)
+            )
+
+        try:
+            instance_dict = object.__getattribute__(obj, "__dict__")
+        except AttributeError:
+            return names
+        if obj is cls or not isinstance(instance_dict, dict) or not instance_dict:
+            return names
+        return _with_styles(
+            sorted(
+                {name for name, _ in names}.union(
+                    name for name in instance_dict if isinstance(name, str)
+                ),
+                key=_completion_sort_key,
+            )
+        )
+
+    def _get_jedi_completions(
+        self,
+        text_before: str,
+        text_after: str,
+        locals: Dict[str, Any],
+        globals: Dict[str, Any],
+    ) -> List[Tuple[str, str]]:
+        " Return `(name, style)` for all the Jedi completions at the cursor. "
+        script = get_jedi_script_from_document(
+            Document(text_before + text_after, len(text_before)), locals, globals,
+        )
+        if not script:
+            return []
+
+        try:
+            return [
+                (c.name_with_symbols, _get_style_for_name(c.name_with_symbols))
+                for c in script.completions()
+            ]
+        except TypeError:
+            # Issue #9: bad syntax causes completions() to fail in jedi.
+            # https://github.com/jonathanslenders/python-prompt-toolkit/issues/9
+            return []
+        except UnicodeDecodeError:
+            # Issue #43: UnicodeDecodeError on OpenBSD
+            # https://github.com/jonathanslenders/python-prompt-toolkit/issues/43
+            return []
+        except AttributeError:
+            # Jedi issue #513: https://github.com/davidhalter/jedi/issues/513
+            return []
+        except ValueError:
+            # Jedi issue: "ValueError: invalid \x escape"
+            return []
+        except KeyError:
+            # Jedi issue: "KeyError: u'a_lambda'."
+            # https://github.com/jonathanslenders/ptpython/issues/89
+            return []
+        except IOError:
+            # Jedi issue: "IOError: No such file or directory."
+            # https://github.com/jonathanslenders/ptpython/issues/71
+            return []
+        except AssertionError:
+            # In jedi.parser.__init__.py: 227, in remove_last_newline,
+            # the assertion "newline.value.endswith('\n')" can fail.
+            return []
+        except SystemError:
+            # In jedi.api.helpers.py: 144, in get_stack_at_position
+            # raise SystemError("This really shouldn't happen. There's a bug in Jedi.")
+            return []
+        except NotImplementedError:
+            # See: https://github.com/jonathanslenders/ptpython/issues/223
+            return []
+        except Exception:
+            # Supress all other Jedi exceptions.
+            return []
 
 
 class DictionaryCompleter(Completer):
@@ -220,11 +425,15 @@ class DictionaryCompleter(Completer):
              function calls, so it only triggers attribute access.
     """
 
-    def __init__(self, get_globals, get_locals):
+    def __init__(self, get_globals, get_locals, get_namespace_version=None):
         super().__init__()
 
         self.get_globals = get_globals
         self.get_locals = get_locals
+        self.get_namespace_version = get_namespace_version or (lambda: None)
+
+        # (key, {varname: value}) of the last for-loop scan.
+        self._for_loop_cache: Optional[Tuple[tuple, Dict[str, Any]]] = None
 
         # Pattern for expressions that are "safe" to eval for auto-completion.
         # These are expressions that contain only attribute and index lookups.
@@ -301,10 +510,10 @@ class DictionaryCompleter(Completer):
             re.VERBOSE,
         )
 
-    def _lookup(self, expression: str, temp_locals: Dict[str, Any]) -> object:
+    def _lookup(self, expression: str, temp_locals: Mapping[str, Any]) -> object:
         """
         Do lookup of `object_var` in the context.
-        `temp_locals` is a dictionary, used for the locals.
+        `temp_locals` is a mapping, used for the locals.
         """
         try:
             return eval(expression.strip(), self.get_globals(), temp_locals)
@@ -317,17 +526,10 @@ class DictionaryCompleter(Completer):
 
         # First, find all for-loops, and assing the first item of the
         # collections they're iterating to the iterator variable, so that we
-        # can provide code completion on the iterators.
-        temp_locals = self.get_locals().copy()
-
-        for match in self.for_loop_pattern.finditer(document.text_before_cursor):
-            varname, expression = match.groups()
-            expression_val = self._lookup(expression, temp_locals)
-
-            # We do this only for lists and tuples. Calling `next()` on any
-            # collection would create undesired side effects.
-            if isinstance(expression_val, (list, tuple)) and expression_val:
-                temp_locals[varname] = expression_val[0]
+        # can provide code completion on the iterators. (The namespace itself
+        # is not copied, the variables go in an overlay.)
+        locals = self.get_locals()
+        temp_locals = ChainMap(self._get_for_loop_variables(document, locals), locals)
 
         # Get all completions.
         yield from self._get_expression_completions(
@@ -340,6 +542,46 @@ class DictionaryCompleter(Completer):
             document, complete_event, temp_locals
         )
 
+    def _get_for_loop_variables(
+        self, document: Document, locals: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """
+        Return the iterator variables of the for-loops before the cursor.
+
+        A for-loop ends with a colon, so the result is cached for the text up
+        to the last colon: typing after it doesn't scan the text again.
+        """
+        text = document.text_before_cursor
+        text = text[: text.rfind(":") + 1]
+        globals = self.get_globals()
+        key = (
+            text,
+            self.get_namespace_version(),
+            id(locals),
+            len(locals),
+            id(globals),
+            len(globals),
+        )
+
+        cache = self._for_loop_cache
+        if cache is not None and cache[0] == key:
+            return cache[1]
+
+        variables: Dict[str, Any] = {}
+        temp_locals = ChainMap(variables, locals)
+
+        for match in self.for_loop_pattern.finditer(text):
+            varname, expression = match.groups()
+            expression_val = self._lookup(expression, temp_locals)
+
+            # We do this only for lists and tuples. Calling `next()` on any
+            # collection would create undesired side effects.
+            if isinstance(expression_val, (list, tuple)) and expression_val:
+                variables[varname] = expression_val[0]
+
+        self._for_loop_cache = (key, variables)
+        return variables
+
     def _do_repr(self, obj: object) -> str:
         try:
             return str(repr(obj))
@@ -350,7 +592,7 @@ class DictionaryCompleter(Completer):
         self,
         document: Document,
         complete_event: CompleteEvent,
-        temp_locals: Dict[str, Any],
+        temp_locals: Mapping[str, Any],
     ) -> Iterable[Completion]:
         """
         Complete the [ or . operator after an object.
@@ -369,7 +611,7 @@ class DictionaryCompleter(Completer):
         self,
         document: Document,
         complete_event: CompleteEvent,
-        temp_locals: Dict[str, Any],
+        temp_locals: Mapping[str, Any],
     ) -> Iterable[Completion]:
         """
         Complete dictionary keys.
@@ -426,7 +668,7 @@ class DictionaryCompleter(Completer):
         self,
         document: Document,
         complete_event: CompleteEvent,
-        temp_locals: Dict[str, Any],
+        temp_locals: Mapping[str, Any],
     ) -> Iterable[Completion]:
         """
         Complete attribute names.
@@ -482,7 +724,7 @@ def create_ptpycompleter(inp):
     return GrammarCompleter(
             create_ptpygrammar(),
             {
-                'python' : PythonCompleter(inp.get_globals, inp.get_locals, lambda: inp.enable_dictionary_completion),
+                'python' : PythonCompleter(inp.get_globals, inp.get_locals, lambda: inp.enable_dictionary_completion, lambda: inp.kernel, lambda: inp.current_statement_index),
                 'magic' : MagicCompleter(),
                 'py_filename': PathCompleter(only_directories=False, file_filter=lambda name: name.endswith('.py') or '.' not in name),
                 'filename': PathCompleter(only_directories=False),
@@ -511,12 +753,16 @@ class ReprFailedError(Exception):
     " Raised when the repr() call in `DictionaryCompleter` fails. "
 
 
-try:
-    import builtins
+_builtin_names = frozenset(dir(builtins))
+
+
+def _with_styles(names: Iterable[str]) -> List[Tuple[str, str]]:
+    return [(name, _get_style_for_name(name)) for name in names]
+
 
-    _builtin_names = dir(builtins)
-except ImportError:  # Python 2.
-    _builtin_names = []
+def _completion_sort_key(name: str) -> Tuple[bool, bool, str]:
+    " Sort like Jedi: alphabetically, with the underscore names at the end. "
+    return (name.startswith("__"), name.startswith("_"), name.lower())
 
 
 def _get_style_for_name(name: str) -> str:
@@ -1,14 +1,18 @@
+import mmap
 import string
+import sys
+import time
+import types
 import unicodedata
-from itertools import groupby, cycle, chain
-from functools import partial
+import warnings
+from itertools import groupby, cycle, chain, islice
+from functools import lru_cache, partial
 import reprlib
 
 from prompt_toolkit.formatted_text import  (
     FormattedText,
     PygmentsTokens,
     fragment_list_width,
-    merge_formatted_text,
     to_formatted_text,
 )
 from pygments.lexers import PythonLexer, PythonTracebackLexer
@@ -16,7 +20,64 @@ from pygments.token import Token
 
 MAX_LIST_DEPTH = reprlib.Repr().maxlevel
 
+# Containers with this many items are formatted and written one item at a
+# time, see `iter_format`.
+MAX_MULTILINE_ITEMS = 400
+
+# Smaller containers are formatted one item at a time too, when their output
+# is longer than this. Long strings are formatted in pieces of this size.
+CHUNK_CHARS = 4096
+
+# Default budget for formatting one object: the number of container items and
+# the number of characters. Past the budget, only the head and the tail of
+# containers and strings are formatted.
+MAX_ITEMS = 10000
+MAX_CHARS = 1000000
+
+# Containers and strings show at least this much, even without budget.
+MIN_ITEMS = 2
+MIN_CHARS = 64
+
+# Head and tail sizes of NumPy arrays (per axis) and pandas objects (rows),
+# when they are summarized.
+ARRAY_EDGE_ITEMS = 3
+FRAME_EDGE_ROWS = 5
+
+# Hexdumps are formatted in windows of this many bytes, and cut at multiples
+# of it when they don't fit in the budget.
+HEXDUMP_WINDOW = 4096
+HEXDUMP_ALIGN = 256
+
+# Repeated references to a container or object are displayed again when they
+# are at most this long, and as a back-reference otherwise.
+MAX_REPEATED_WIDTH = 40
+
+# Seconds that evaluating a property of an object may take. After a property
+# that took longer, the others of that object aren't evaluated.
+PROPERTY_TIME_BUDGET = 0.1
+
+
+class FormattingCancelled(Exception):
+    " Raised by `iter_format` when its `cancel` event is set. "
+
+
 class PtPyFormatter:
+    # Formatters for built-in types, by method name. Types that aren't
+    # registered are displayed with `obj_fmt` or `repr`.
+    _builtin_writers = {
+        bool: '_write_bool',
+        int: '_write_int',
+        str: '_write_str',
+        bytes: '_write_bytes',
+        bytearray: '_write_bytes',
+        memoryview: '_write_bytes',
+        mmap.mmap: '_write_bytes',
+        list: '_write_collection',
+        tuple: '_write_collection',
+        set: '_write_collection',
+        dict: '_write_collection',
+    }
+
     def __init__(self, int_fmt=None, str_fmt=None, bytes_fmt=None, obj_fmt=None):
         if int_fmt is None:
             self.set_int_fmt()
@@ -40,6 +101,86 @@ class PtPyFormatter:
         else:
             self.obj_fmt = obj_fmt
 
+        self.max_items = MAX_ITEMS
+        self.max_chars = MAX_CHARS
+        self._reset_state()
+
+        # Width of the terminal. Containers that don't fit on the rest of the
+        # line are broken over several lines.
+        self.width = 80
+
+        # Properties and other descriptors of objects run code, like a
+        # database query. By default, they are displayed as not evaluated.
+        self.evaluate_properties = False
+        self.property_time_budget = PROPERTY_TIME_BUDGET
+
+        # Event that stops the chunk of `iter_format` that is being formatted.
+        self._cancel = None
+
+        # Type -> writer, and the writer for every type that was looked up
+        # through its MRO.
+        self._registry = {cls: getattr(self, name) for cls, name in self._builtin_writers.items()}
+        self._dispatch_cache = {}
+        self._entry_points_loaded = False
+
+    def register(self, cls, func=None):
+        """
+        Register `func(o, formatter, indent)` as the formatter for instances of
+        `cls` and its subclasses, like `functools.singledispatch`. It returns
+        formatted text, and can call `formatter.format(value, indent + 1)` for
+        nested values. Can be used as a decorator::
+
+            @repl.formatter.register(Decimal)
+            def _(o, formatter, indent):
+                return [('class:pygments.number', str(o))]
+        """
+        if func is None:
+            return lambda func: self.register(cls, func)
+        self._registry[cls] = partial(self._write_registered, func)
+        self._dispatch_cache.clear()
+        return func
+
+    def load_entry_points(self, group='ptpython.formatters'):
+        """
+        Call every `ptpython.formatters` entry point with this formatter, so
+        that installed packages can register formatters. This happens when
+        the first object is formatted.
+        """
+        self._entry_points_loaded = True
+        try:
+            from importlib import metadata
+        except ImportError:
+            # Python < 3.8
+            try:
+                import importlib_metadata as metadata  # type: ignore
+            except ImportError:
+                return
+        try:
+            entry_points = metadata.entry_points(group=group)
+        except TypeError:
+            # Python < 3.10
+            entry_points = metadata.entry_points().get(group, [])
+        for entry_point in entry_points:
+            try:
+                entry_point.load()(self)
+            except Exception as ex:
+                warnings.warn(f'Failed to load formatters from {entry_point.name}: {ex}')
+
+    def _dispatch(self, cls):
+        """
+        Return the writer for the first class in the MRO of `cls` that has
+        one, or `None`.
+        """
+        try:
+            return self._dispatch_cache[cls]
+        except KeyError:
+            pass
+        if not self._entry_points_loaded:
+            self.load_entry_points()
+        writer = next((self._registry[c] for c in cls.__mro__ if c in self._registry), None)
+        self._dispatch_cache[cls] = writer
+        return writer
+
     def set_obj_fmt_simple(self):
         self.obj_fmt = lambda o: FormattedText([('', repr(o))])
 
@@ -50,63 +191,506 @@ class PtPyFormatter:
         self.bytes_fmt = partial(display_bytes, show_index=show_index,
             show_ascii=show_ascii,
             line_items=line_items,
-            index_color='class:blue',
-            ascii_color='class:magenta')
+            index_color=index_color,
+            ascii_color=ascii_color)
 
     def set_int_fmt(self, format_string='d', prefix='', base_width=1):
         self.int_fmt = partial(display_int, format_string=format_string, prefix=prefix, base_width=base_width)
 
+    def _reset_state(self):
+        " Start formatting a new object. "
+        self._items_left = self.max_items
+        self._chars_left = self.max_chars
+
+        # Objects that were written already: id -> (object, fragments or
+        # None, width, line breaks, containers). The object is kept to make sure that the id isn't
+        # reused. And the ids of the objects that are being written.
+        self._memo = {}
+        self._active = set()
+
+        # The number of objects with line breaks and of containers that were
+        # written, to find out what a container contains.
+        self._line_breaks = 0
+        self._groups = 0
+
     def format(self, o, list_depth=0, force_pretty_repr=False):
-        if isinstance(o, bool):
-            return FormattedText([('class:pygments.keyword.constant', str(o))])
-        elif isinstance(o, int):
-            return self.int_fmt(o)
-        elif isinstance(o, str):
-            return self.str_fmt(o)
-        elif isinstance(o, bytes):
-            return self.bytes_fmt(o, indent=list_depth)
-        elif isinstance(o, (list, set, dict, tuple)):
-            parens = '[]' if isinstance(o, list) else '()' if isinstance(o, tuple) else '{}'
-            if len(o) == 0:
-                return FormattedText([('', parens)])
-            out = [
-                    [('', parens[0])],
-                    self.joindict(o, list_depth + 1) if isinstance(o, dict) else self.joinlist(o, list_depth + 1),
-                    [('', parens[1])]
-                ]
-            return merge_formatted_text(out)()
+        if list_depth == 0:
+            self._reset_state()
+        out = FormattedText()
+        self._write(o, out, list_depth, force_pretty_repr)
+        if list_depth == 0:
+            _layout(out, self.width)
+        # (Otherwise, the caller writes it in a container, which is laid out
+        # as a whole.)
+        return out
+
+    def iter_format(self, o, cancel=None):
+        """
+        Like `format`, but yield `(fragments, remaining)` tuples, where
+        `remaining` is the number of top-level items that still follow. Large
+        containers are formatted one item at a time, so that the output can
+        be written (or abandoned) before everything is formatted.
+
+        :param cancel: `threading.Event`. When it is set, formatting stops
+            with `FormattingCancelled`, even in the middle of a chunk.
+        """
+        chunks = self._iter_format(o)
+        while True:
+            if cancel is not None and cancel.is_set():
+                raise FormattingCancelled
+            # Set for every chunk: other iterators can use this formatter
+            # in between.
+            self._cancel = cancel
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                self._cancel = None
+            yield chunk
+
+    def _iter_format(self, o):
+        if isinstance(o, dict):
+            num_items = 2 * len(o)  # (Like `_write_dict` counts them.)
+        elif isinstance(o, (list, set, tuple)):
+            num_items = len(o)
+        else:
+            num_items = 0
+        if isinstance(o, (bytes, bytearray, memoryview, mmap.mmap)) and _nbytes(o) > HEXDUMP_WINDOW:
+            yield from self.iter_hexdump(o)
+            return
+        if type(o) is str and len(o) > CHUNK_CHARS:
+            yield from self._iter_str(o)
+            return
+        if num_items < MAX_MULTILINE_ITEMS and (
+            num_items == 0 or self._fits_in_chunk(o)
+        ):
+            yield self.format(o), 0
+            return
+
+        # Every chunk is laid out on its own, as part of a group that never
+        # fits on one line.
+        parens = '[]' if isinstance(o, list) else '()' if isinstance(o, tuple) else '{}'
+        group = _Group(1, fill=not isinstance(o, dict))
+        column = 1
+        yield FormattedText([('', parens[0])]), len(o)
+        for i, item in enumerate(o.items() if isinstance(o, dict) else o, 1):
+            self._reset_state()
+            self._active.add(id(o))
+            out = FormattedText([group.start])
+            if i > 1:
+                joiner = _Break()
+                out.append(('', ', ', joiner))
+            if isinstance(o, dict):
+                width = self._write_pair(item, out, 1)
+            else:
+                width = self._write(item, out, 1)
+            if i > 1:
+                joiner.width = width
+            group.multiline = self._line_breaks > 0
+            group.has_groups = self._groups > 0
+            if i == len(o):
+                out.append(('', parens[1]))
+            out.append(group.end)
+            column = _layout(out, self.width, column)
+            yield out, len(o) - i
+
+    def _fits_in_chunk(self, o):
+        """
+        Whether the output of the container `o` is at most `CHUNK_CHARS` long.
+        With that as the budget, no more than that is formatted to find out.
+        """
+        self._reset_state()
+        self._items_left = self._chars_left = CHUNK_CHARS
+        self._write(o, FormattedText())
+        return self._items_left > 0 and self._chars_left > 0
+
+    def _iter_str(self, s):
+        """
+        Yield a long string in pieces of about `CHUNK_CHARS` characters, that
+        end at a line break where possible. Like `_write_str`, only the head
+        and the tail are written when it's longer than `max_chars`.
+        """
+        limit = max(self.max_chars, MIN_CHARS)
+        if len(s) <= limit:
+            ranges = [(0, len(s))]
+        else:
+            head = (limit + 1) // 2
+            ranges = [(0, head), (len(s) - limit + head, len(s))]
+
+        for i, (start, end) in enumerate(ranges):
+            if i > 0:
+                out = FormattedText()
+                self._write_elision_marker(len(s) - limit, out, 'characters ')
+                yield out, 0
+            while start < end:
+                stop = min(end, start + CHUNK_CHARS)
+                if stop < end:
+                    stop = s.rfind('\n', start, stop) + 1 or stop
+                yield self.str_fmt(s[start:stop]), 0
+                start = stop
+
+    def iter_hexdump(self, o, offset=0, length=None):
+        """
+        Yield the hexdump of the `length` bytes of `o` at `offset`, in
+        windows of `HEXDUMP_WINDOW` bytes, as `(fragments, remaining bytes)`
+        tuples, like `iter_format`.
+        """
+        size = _nbytes(o)
+        end = size if length is None else min(size, offset + length)
+        while True:
+            length = max(0, min(HEXDUMP_WINDOW, end - offset))
+            out = to_formatted_text(self.bytes_fmt(o, offset=offset, length=length))
+            offset += length
+            if offset >= end:
+                yield strip(out), 0
+                return
+            yield out, end - offset
+
+    # The `_write` methods append the fragments of an object to `out` and
+    # return their length in characters when containers are written on one
+    # line, so that every fragment is created once, and the lengths are added
+    # up bottom-up. Where containers are broken over lines is decided
+    # afterwards, by `_layout`.
+
+    def _write(self, o, out, list_depth=0, force_pretty_repr=False):
+        if self._cancel is not None and self._cancel.is_set():
+            raise FormattingCancelled
+        writer = self._dispatch(type(o))
+        if writer is not None:
+            return writer(o, out, list_depth)
+        array_fmt = _get_array_formatter(o)
+        if array_fmt is not None:
+            return self._write_shared(
+                o, out, partial(self._write_array, o, out, list_depth, array_fmt),
+                f'<{type(o).__qualname__}...>')
         if force_pretty_repr or type(o).__repr__ is object.__repr__:
-            return self.obj_fmt(o, indent=list_depth)
-        return FormattedText([('', repr(o))])
+            return self._write_shared(
+                o, out, lambda: self._write_formatted(self.obj_fmt(o, indent=list_depth), out),
+                f'<{type(o).__qualname__}...>')
+        text = repr(o)
+        self._chars_left -= len(text)
+        if '\n' in text:
+            self._line_breaks += 1
+        out.append(('', text))
+        return len(text)
+
+    def _write_bool(self, o, out, list_depth):
+        out.append(('class:pygments.keyword.constant', str(o)))
+        return len(out[-1][1])
+
+    def _write_int(self, o, out, list_depth):
+        width = _extend(out, self.int_fmt(o))
+        self._chars_left -= width
+        return width
+
+    def _write_collection(self, o, out, list_depth):
+        parens = '[]' if isinstance(o, list) else '()' if isinstance(o, tuple) else '{}'
+        if len(o) == 0:
+            out.append(('', parens))
+            return 2
+        return self._write_shared(
+            o, out, partial(self._write_container, o, out, list_depth, parens),
+            f'{parens[0]}...{parens[1]}')
+
+    def _write_registered(self, func, o, out, list_depth):
+        def write():
+            width = self._write_formatted(func(o, self, list_depth), out)
+            self._chars_left -= width
+            return width
+        return self._write_shared(o, out, write, f'<{type(o).__qualname__}...>')
+
+    def _write_formatted(self, formatted_text, out):
+        " Write the output of a formatter function. "
+        start = len(out)
+        width = _extend(out, formatted_text)
+        if any('\n' in fragment[1] for fragment in islice(out, start, None)):
+            self._line_breaks += 1
+        return width
+
+    def _write_container(self, o, out, list_depth, parens):
+        group = _Group(list_depth + 1, fill=not isinstance(o, dict))
+        line_breaks, groups = self._line_breaks, self._groups
+        out.extend([group.start, ('', parens[0])])
+        if isinstance(o, dict):
+            width = self._write_dict(o, out, list_depth + 1)
+        else:
+            width = self._write_list(o, out, list_depth + 1)
+        out.extend([('', parens[1]), group.end])
+        group.width = width + 2
+        group.multiline = self._line_breaks > line_breaks
+        group.has_groups = self._groups > groups
+        self._groups += 1
+        return group.width
+
+    def _write_array(self, o, out, list_depth, array_fmt):
+        width = _extend(out, array_fmt(o, indent=list_depth))
+        self._chars_left -= width
+        self._line_breaks += 1  # (The header is on a line of its own.)
+        return width
+
+    def _write_shared(self, o, out, write, back_reference):
+        """
+        Call `write()` for an object that can be referenced more than once.
+        A reference to an object that contains it (a cycle) is written as
+        `back_reference`, like `repr` writes `[...]`. Further references to
+        an object that was written already are written again if that's
+        short, or as `<same list as above>` otherwise. Either way, every
+        object is formatted once.
+        """
+        key = id(o)
+        memo = self._memo.get(key)
+        if key in self._active:
+            out.append(('class:gray', back_reference))
+            return len(back_reference)
+        if memo is not None and memo[1] is None:
+            out.append(('class:gray', f'<same {type(o).__qualname__} as above>'))
+            return len(out[-1][1])
+        if memo is not None:
+            out.extend(memo[1])
+            self._line_breaks += memo[3]
+            self._groups += memo[4]
+            return memo[2]
+
+        self._active.add(key)
+        start = len(out)
+        line_breaks, groups = self._line_breaks, self._groups
+        try:
+            width = write()
+        finally:
+            self._active.discard(key)
+        self._memo[key] = (
+            o,
+            out[start:] if width <= MAX_REPEATED_WIDTH else None,
+            width,
+            self._line_breaks - line_breaks,
+            self._groups - groups,
+        )
+        return width
+
+    def _write_bytes(self, o, out, list_depth):
+        """
+        Write a hexdump, or the head and tail of it if it's longer than the
+        remaining budget.
+        """
+        try:
+            size = _nbytes(o)
+        except ValueError:
+            # Closed mmap or released memoryview.
+            out.append(('', repr(o)))
+            return len(out[-1][1])
+
+        # About four characters per byte.
+        limit = max(self._chars_left // 4, HEXDUMP_ALIGN)
+        head = max(limit // 2 // HEXDUMP_ALIGN * HEXDUMP_ALIGN, HEXDUMP_ALIGN)
+        tail_start = -(-(size - head) // HEXDUMP_ALIGN) * HEXDUMP_ALIGN
+        if size <= limit or tail_start <= head:
+            width = _extend(out, self.bytes_fmt(o, indent=list_depth))
+        else:
+            width = _extend(out, self.bytes_fmt(o, indent=list_depth, length=head))
+            out.append(('', '  ' * list_depth))
+            width += 2 * list_depth + self._write_elision_marker(tail_start - head, out, 'bytes ')
+            out.append(('', '\n'))
+            width += 1 + _extend(out, self.bytes_fmt(o, indent=list_depth, offset=tail_start))
+        self._chars_left -= width
+        self._line_breaks += 1
+        return width
+
+    def _write_str(self, s, out, list_depth=0):
+        """
+        Write a string, or only its head and tail if it's longer than the
+        remaining budget.
+        """
+        limit = max(self._chars_left, MIN_CHARS)
+        self._chars_left -= min(len(s), limit)
+        if '\n' in s:
+            self._line_breaks += 1
+        if len(s) <= limit:
+            return _extend(out, self.str_fmt(s))
+        head = (limit + 1) // 2
+        width = _strip_newline(out, _extend(out, self.str_fmt(s[:head])))
+        width += self._write_elision_marker(len(s) - limit, out, 'characters ')
+        return width + _extend(out, self.str_fmt(s[head - limit:]))
+
+    def _take_items(self, o):
+        """
+        Take as many items of the container as the budget allows, but at least
+        `MIN_ITEMS`. Return `(head, omitted, tail)`: the items before the
+        elision marker, the number of items left out and the items after it.
+        Only the items that are taken are iterated over, except for sets.
+        """
+        n = len(o)
+        items = o.items() if isinstance(o, dict) else o
+        budget = self._items_left if self._chars_left > 0 else 0
+        show = min(n, max(budget, MIN_ITEMS))
+        self._items_left -= show
+        if show == n:
+            return items, 0, ()
+
+        tail = show // 2
+        if isinstance(o, (list, tuple)):
+            return o[:show - tail], n - show, o[n - tail:]
+        if isinstance(o, dict):
+            if sys.version_info >= (3, 8):
+                tail_items = list(islice(reversed(items), tail))[::-1]
+            else:
+                # Dict views can't be reversed before Python 3.8.
+                tail_items = list(islice(items, n - tail, None))
+            return islice(items, show - tail), n - show, tail_items
+        return islice(items, show), n - show, ()
 
     @staticmethod
-    def _get_joiner(list_num_items, list_depth, inner_len, inner_num_items):
-        joiner = (',\n' + '  ' * list_depth
-                ) if (2 * (inner_num_items - 1) + inner_len > 6 * 78 and list_num_items < 400
-                ) else ', '
-        return FormattedText([('', joiner)])
+    def _write_elision_marker(omitted, out, unit=''):
+        out.append(('class:gray', f'... {omitted} more {unit}...'))
+        return len(out[-1][1])
 
-    def joinlist(self, lst, list_depth):
+    def _write_pair(self, item, out, list_depth):
+        k, v = item
+        width = _strip_newline(out, self._write(k, out, list_depth))
+        out.append(('', ': '))
+        return width + 2 + _strip_newline(out, self._write(v, out, list_depth))
+
+    def _write_items(self, o, write_item, out, list_depth):
+        """
+        Write the items of a container, with a `_Break` marker before every
+        item but the first, and return the width.
+        """
+        head, omitted, tail = self._take_items(o)
+        width = 0
+        joiner = None
+        for item in head:
+            if joiner is None:
+                joiner = _Break()  # Not written.
+            else:
+                joiner = _Break()
+                out.append(('', ', ', joiner))
+                width += 2
+            joiner.width = write_item(item, out, list_depth)
+            width += joiner.width
+        if omitted:
+            joiner = _Break()
+            out.append(('', ', ', joiner))
+            joiner.width = self._write_elision_marker(omitted, out)
+            width += 2 + joiner.width
+        for item in tail:
+            joiner = _Break()
+            out.append(('', ', ', joiner))
+            joiner.width = write_item(item, out, list_depth)
+            width += 2 + joiner.width
+        return width
+
+    def _write_list(self, lst, out, list_depth):
         if list_depth > MAX_LIST_DEPTH:
-            return FormattedText([('class:gray', '...')])
-        inner = [ self.format(a, list_depth) for a in lst ]
-        ln = get_formatted_text_length(merge_formatted_text(inner)())
-        joiner = self._get_joiner(len(lst), list_depth, ln, len(inner))
-        L = list(chain(*([l, joiner] for l in inner[:-1]), [inner[-1]]))
-        return merge_formatted_text(L)()
-
-    def joindict(self, dct, list_depth):
+            out.append(('class:gray', '...'))
+            return 3
+        return self._write_items(lst, self._write, out, list_depth)
+
+    def _write_dict(self, dct, out, list_depth):
         if list_depth > MAX_LIST_DEPTH:
-            return FormattedText([('class:gray', '...')])
-        inner = list(
-                chain(*(
-                    [strip(self.format(k, list_depth)), FormattedText([('', ': ')]),
-                        strip(self.format(v, list_depth))]
-             for k, v in dct.items())))
-        ln = get_formatted_text_length(merge_formatted_text(inner)())
-        joiner = self._get_joiner(2 * len(dct), list_depth, ln, len(inner))
-        L = list(chain(*([l] + ([joiner] if j % 3 == 2 else []) for j, l in enumerate(inner[:-1])), [inner[-1]]))
-        return merge_formatted_text(L)()
+            out.append(('class:gray', '...'))
+            return 3
+        return self._write_items(dct, self._write_pair, out, list_depth)
+
+
+class _Marker:
+    """
+    Base class of the markers for `_layout`, in the mouse handler position of
+    the fragments. They stay in the output, and ignore mouse events.
+    """
+    __slots__ = ()
+
+    def __call__(self, mouse_event):
+        return NotImplemented
+
+
+class _Group(_Marker):
+    """
+    Marker for a container in the fragments, that `_layout` writes on one line
+    if it fits, and otherwise breaks at its `_Break` markers. Its width on one
+    line, and whether it contains line breaks or other containers, are
+    computed once, when it's written.
+
+    :param depth: Indentation of the items after a line break.
+    :param fill: Whether items are put on a line as long as they fit, when
+        they are no containers themselves, instead of one item per line.
+    """
+    __slots__ = ('depth', 'fill', 'width', 'multiline', 'has_groups', 'start', 'end')
+
+    def __init__(self, depth, fill):
+        self.depth = depth
+        self.fill = fill
+        self.width = sys.maxsize
+        self.multiline = False
+        self.has_groups = False
+        # The fragments around the container. (The end is unique, so that
+        # `list.index` can find it.)
+        self.start = ('', '', self)
+        self.end = ('', '', _Marker())
+
+
+class _Break(_Marker):
+    " Marker for the joiner before an item of a `_Group`, of width `width`. "
+    __slots__ = ('width',)
+
+    def __init__(self):
+        self.width = 0
+
+
+def _layout(out, columns, column=0):
+    """
+    Replace the joiners in `out` where a line break is needed: like Wadler's
+    pretty printer, a group is written on one line when its width fits on
+    the rest of the line, and broken over lines otherwise. Groups that
+    contain line breaks never fit. `column` is where `out` starts. Return the
+    column where it ends.
+
+    Groups that fit are skipped as a whole, so that only the fragments on
+    lines that are broken are looked at.
+    """
+    # (The last column is kept free, for the ',' or ']' after an item.)
+    stack = []
+    i = 0
+    while i < len(out):
+        fragment = out[i]
+        i += 1
+        if len(fragment) == 3 and isinstance(fragment[2], _Marker):
+            marker = fragment[2]
+            if isinstance(marker, _Group):
+                if not marker.multiline and column + marker.width < columns:
+                    i = out.index(marker.end, i) + 1
+                    column += marker.width
+                else:
+                    stack.append(marker)
+                continue
+            if not isinstance(marker, _Break):
+                stack.pop()
+                continue
+            group = stack[-1]
+            if group.fill and not group.has_groups and column + 2 + marker.width < columns:
+                column += 2
+            else:
+                out[i - 1] = ('', ',\n' + '  ' * group.depth)
+                column = 2 * group.depth
+            continue
+
+        text = fragment[1]
+        newline = text.rfind('\n')
+        column = column + len(text) if newline == -1 else len(text) - newline - 1
+    return column
+
+
+def _extend(out, formatted_text):
+    " Append formatted text to `out`, and return its length. "
+    fragments = to_formatted_text(formatted_text)
+    out.extend(fragments)
+    return sum(len(fragment[1]) for fragment in fragments)
+
+def _strip_newline(out, width):
+    " Like `strip`, for the fragments at the end of `out`. "
+    if out and out[-1][1] == '\n':
+        out.pop()
+        return width - 1
+    return width
 
 
 def strip(x):
@@ -122,75 +706,272 @@ def get_formatted_text_length(x):
 def display_int(x, format_string='d', prefix='', base_width=1):
     x = f'{x:{format_string}}'
     num_zeros = (base_width - len(x) % base_width) % base_width
-    return PygmentsTokens([(Token.Number.Integer, f'{prefix}{"0" * num_zeros}{x}')])
+    return FormattedText([('class:pygments.literal.number.integer', f'{prefix}{"0" * num_zeros}{x}')])
+
+_python_lexer = PythonLexer()
+
+@lru_cache(maxsize=1024)
+def _lex_python(text):
+    # Cached, because the same short strings (like dict keys) are displayed
+    # over and over, and lexing is the slow part of displaying them.
+    return tuple(to_formatted_text(PygmentsTokens(_python_lexer.get_tokens(text))))
+_TAB_NEWLINE = str.maketrans('', '', '\t\n')
 
 def display_string(s):
-    lexer = PythonLexer()
     isprint = lambda ch: ch.isprintable() or ch == '\t' or ch == '\n'
-    out = []
-    for k, g in groupby(s, isprint):
-        g = ''.join(g)
+    if s.translate(_TAB_NEWLINE).isprintable():
+        groups = [(True, s)]
+    else:
+        groups = ((k, ''.join(g)) for k, g in groupby(s, isprint))
+    out = FormattedText()
+    for k, g in groups:
         if k:
-            out.append(PygmentsTokens(lexer.get_tokens(g)))
+            out.extend(_lex_python(g) if len(g) <= 100 else _lex_python.__wrapped__(g))
         else:
-            out.append([('class:gray', repr(g).replace("'", ""))])
-    out = to_formatted_text(merge_formatted_text(out))
+            out.append(('class:gray', repr(g).replace("'", "")))
     if not s.endswith('\n'):
         # strip newline added by the lexer
-        out = strip(out)
+        _strip_newline(out, 0)
     return out
 
+# Class attributes that are read without running code of the object, and the
+# methods, which aren't displayed.
+_SAFE_DESCRIPTORS = (types.MemberDescriptorType, types.GetSetDescriptorType)
+_METHOD_DESCRIPTORS = (
+    types.FunctionType,
+    types.BuiltinFunctionType,
+    type(str.join),  # `types.MethodDescriptorType`, which needs Python 3.7.
+    type(dict.__dict__["fromkeys"]),  # `types.ClassMethodDescriptorType`.
+    type(object.__init__),  # `types.WrapperDescriptorType`.
+    staticmethod,
+    classmethod,
+)
+
+
+def _get_attributes(o):
+    """
+    Return the public attributes of `o`, sorted by name, as `(name, value,
+    evaluated)` tuples, without running any code of `o`. The attributes that
+    would run code (properties and other descriptors) aren't evaluated: their
+    value is the descriptor.
+
+    Like `getattr`, data descriptors of the class win over the instance
+    `__dict__`, which wins over the other class attributes. For a class, the
+    attributes of its MRO are used.
+    """
+    is_class = isinstance(o, type)
+    class_attributes = {}
+    for klass in reversed(o.__mro__ if is_class else type(o).__mro__):
+        class_attributes.update(vars(klass))
+    try:
+        instance_dict = object.__getattribute__(o, '__dict__')
+    except AttributeError:
+        instance_dict = {}
+    if not isinstance(instance_dict, dict):
+        instance_dict = {}  # Like the mappingproxy of a class.
+
+    result = []
+    for name in sorted(set(class_attributes) | set(instance_dict)):
+        if not isinstance(name, str) or name.startswith('_'):
+            continue
+        attr = class_attributes.get(name)
+        is_descriptor = hasattr(type(attr), '__get__')
+        is_data_descriptor = is_descriptor and (
+            hasattr(type(attr), '__set__') or hasattr(type(attr), '__delete__'))
+
+        if name in instance_dict and not is_data_descriptor:
+            result.append((name, instance_dict[name], True))
+        elif isinstance(attr, _METHOD_DESCRIPTORS):
+            continue
+        elif isinstance(attr, _SAFE_DESCRIPTORS) and not is_class:
+            try:
+                result.append((name, attr.__get__(o, type(o)), True))
+            except AttributeError:
+                pass  # An empty slot.
+        elif is_descriptor:
+            result.append((name, attr, False))
+        else:
+            result.append((name, attr, True))
+    return result
+
+
 def display_object(o, formatter, indent=0):
     try:
         type_name = o.__class__.__qualname__
     except AttributeError:
         return FormattedText([('', repr(o))])
-    out = [ FormattedText([('class:gray', '<'), ('class:pygments.name.class', type_name), ('class:gray', '>'), ('', '\n')]) ]
+    out = FormattedText([('class:gray', '<'), ('class:pygments.name.class', type_name), ('class:gray', '>'), ('', '\n')])
     indent += 1
-    for attr in sorted(dir(o)):
-        if attr.startswith('_'):
-            continue
-        val = getattr(o, attr)
-        if callable(val):
+    evaluate = formatter.evaluate_properties
+    for attr, val, evaluated in _get_attributes(o):
+        if not evaluated and evaluate:
+            start = time.perf_counter()
+            try:
+                val = getattr(o, attr)
+                evaluated = True
+            except Exception as e:
+                val = e
+            # The time can't be limited while the property runs: skip the
+            # others after a slow one.
+            if time.perf_counter() - start > formatter.property_time_budget:
+                evaluate = False
+            if isinstance(val, Exception):
+                out.extend([('', '  ' * indent), ('class:pygments.name.attribute', attr), ('', ': '),
+                            ('class:pygments.generic.error', f'<{type(val).__name__}: {val}>'), ('', '\n')])
+                continue
+        if evaluated and callable(val):
             continue
-        out.append(FormattedText([('', '  ' * indent), ('class:pygments.name.attribute', attr), ('', ': ')]))
-        out.append(strip(formatter.format(val, indent + 1)))
-        out.append(FormattedText([('', '\n')]))
-    return merge_formatted_text(out)()
+        out.extend([('', '  ' * indent), ('class:pygments.name.attribute', attr), ('', ': ')])
+        if evaluated:
+            _strip_newline(out, formatter._write(val, out, indent + 1))
+        else:
+            out.append(('class:gray', f'<{type(val).__name__}: not evaluated>'))
+        out.append(('', '\n'))
+    return out
+
 
+def _get_array_formatter(o):
+    """
+    Return the formatter for NumPy arrays and pandas objects, or `None`.
+    NumPy and pandas are never imported here: if they aren't loaded, `o`
+    can't be one of their types.
+    """
+    numpy = sys.modules.get('numpy')
+    if numpy is not None and isinstance(o, numpy.ndarray):
+        return display_ndarray
+    pandas = sys.modules.get('pandas')
+    if pandas is not None:
+        if isinstance(o, pandas.DataFrame):
+            return display_dataframe
+        if isinstance(o, pandas.Series):
+            return display_series
+    return None
+
+def _format_size(n):
+    """Formats a number of bytes in a human readable form"""
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if n < 1024:
+            break
+        n /= 1024
+    else:
+        unit = 'TiB'
+    return f'{n} {unit}' if unit == 'B' else f'{n:0.1f} {unit}'
+
+def _display_table(header, text, indent):
+    """
+    Header line followed by the (already summarized) text of an array or
+    frame, indented when it's nested in a container.
+    """
+    out = FormattedText(header)
+    out.append(('', '\n'))
+    lines = text.split('\n')
+    if indent > 0:
+        lines = ['  ' * indent + line for line in lines]
+    _extend(out, PygmentsTokens(_python_lexer.get_tokens('\n'.join(lines))))
+    _strip_newline(out, 0)
+    return out
+
+def display_ndarray(a, indent=0):
+    """
+    Shape, dtype and size of a NumPy array, and its head and tail along each
+    axis. NumPy summarizes large arrays by slicing, so only the displayed
+    items are formatted.
+    """
+    import numpy
+
+    text = numpy.array2string(a, threshold=1000, edgeitems=ARRAY_EDGE_ITEMS, separator=', ')
+    return _display_table([
+        ('class:pygments.name.class', type(a).__qualname__),
+        ('class:gray', f' shape={a.shape} dtype={a.dtype} {_format_size(a.nbytes)}'),
+        ], text, indent)
+
+def display_dataframe(df, indent=0):
+    """
+    Shape, column dtypes and (shallow) memory usage of a pandas DataFrame,
+    and its head and tail rows.
+    """
+    dtypes = ', '.join(f'{dtype}({count})' for dtype, count in df.dtypes.value_counts().items())
+    text = df.to_string(
+        max_rows=2 * FRAME_EDGE_ROWS, min_rows=2 * FRAME_EDGE_ROWS, max_cols=20, show_dimensions=False)
+    return _display_table([
+        ('class:pygments.name.class', type(df).__qualname__),
+        ('class:gray', f' shape={df.shape} dtypes: {dtypes} '
+            f'{_format_size(int(df.memory_usage(deep=False).sum()))}'),
+        ], text, indent)
+
+def display_series(series, indent=0):
+    """
+    Name, length, dtype and (shallow) memory usage of a pandas Series, and
+    its head and tail rows.
+    """
+    text = series.to_string(
+        max_rows=2 * FRAME_EDGE_ROWS, min_rows=2 * FRAME_EDGE_ROWS, length=False, dtype=False, name=False)
+    return _display_table([
+        ('class:pygments.name.class', type(series).__qualname__),
+        ('class:gray', f' name={series.name!r} length={len(series)} dtype={series.dtype} '
+            f'{_format_size(int(series.memory_usage(deep=False)))}'),
+        ], text, indent)
+
+# Maps every byte to itself if it's printable ASCII, and to '.' otherwise.
+_ASCII_TABLE = bytes(ch if 32 <= ch < 127 else ord('.') for ch in range(256))
+
+def _byte_view(seq):
+    " Zero-copy memoryview of the bytes of `seq`. "
+    view = memoryview(seq)
+    if view.format != 'B' or view.ndim != 1:
+        view = view.cast('B') if view.c_contiguous else memoryview(view.tobytes())
+    return view
+
+def _nbytes(seq):
+    return memoryview(seq).nbytes
+
+def display_bytes(seq, show_index=True, show_ascii=True, line_items=16, index_color='class:blue', ascii_color='class:magenta', indent=0, offset=0, length=None):
+    """
+    Hexdump of `seq` (bytes, bytearray, memoryview, mmap, ...), or of the
+    `length` bytes at `offset`. The hex and ASCII columns of the whole window
+    are converted at once, so only the window is ever copied.
+    """
+    view = _byte_view(seq)
+    size = len(view)
+    if size == 0:
+        return FormattedText([('', repr(seq) if isinstance(seq, (bytes, bytearray)) else "b''")])
+    start = min(offset, size)
+    end = size if length is None else min(size, start + length)
+    window = view[start:end]
 
-def display_bytes(seq, show_index=True, show_ascii=True, line_items=16, index_color='class:blue', ascii_color='class:magenta', indent=0):
     half_line_items = line_items // 2
+    index_digits = len(f'{size - 1:x}')
+    index_digits = max(2, index_digits + index_digits % 2)
+    # Pad short lines to the width of a full line, unless there is only one.
+    hex_width = 3 * line_items + 2 if size > line_items else 0
 
-    num_lines = (len(seq) + line_items - 1) // line_items
-    max_index_len = 2 * ((num_lines * line_items + 255) // 256)
-    index_template = ('%%0%dx  ' % max_index_len) if show_index else ''
+    if sys.version_info >= (3, 8):
+        hex_text = window.hex(' ')
+    else:
+        # (`memoryview.hex` only takes a separator from Python 3.8 on.)
+        hex_digits = window.hex()
+        hex_text = ' '.join([hex_digits[i:i + 2] for i in range(0, len(hex_digits), 2)])
+    ascii_text = window.tobytes().translate(_ASCII_TABLE).decode('ascii') if show_ascii else ''
 
-    out = []
-    ascii_offset = 0
-    for line in range(num_lines):
-        offset = line * line_items
-        items = seq[offset:offset+line_items]
-        num_items = len(items)
+    out = FormattedText()
+    if indent > 0 and start == 0:
+        out.append(('', '\n'))
+    for lo in range(0, end - start, line_items):
+        num_items = min(line_items, end - start - lo)
         if indent > 0:
-            if line == 0:
-                out.append(('', '\n'))
-            out.append('  ' * indent)
+            out.append(('', '  ' * indent))
         if show_index:
-            out.append((index_color, f'{index_template % offset}'))
+            out.append((index_color, f'{start + lo:0{index_digits}x}  '))
 
-        right_len = num_items - half_line_items
-        hex_template = ('%02x ' * min(half_line_items, num_items) + ' ' + ('%02x ' * max(0, right_len)))
-        out_line = f'{hex_template % tuple(items)} '
+        # Every byte takes three characters in `hex_text`: 'xx '.
+        left = hex_text[3 * lo:3 * (lo + min(num_items, half_line_items)) - 1]
+        right = hex_text[3 * (lo + half_line_items):3 * (lo + num_items) - 1] if num_items > half_line_items else ''
+        out_line = f'{left}  {right + " " if right else ""} '
 
-        if num_items == line_items:
-            ascii_offset = len(out_line)
         if show_ascii:
-            out_line = out_line.ljust(ascii_offset, ' ')
-            out.append(('', out_line))
-            out_line = ''.join( ( chr(ch) if (ch < 127 and ch > 31) else '.' for ch in items))
-            out_line += ' ' * (line_items - num_items)
-            out.append((ascii_color, out_line))
-            out_line = ''
-        out.append(('', out_line + '\n'))
-    return FormattedText(out)
+            out.append(('', out_line.ljust(hex_width)))
+            out.append((ascii_color, ascii_text[lo:lo + num_items].ljust(line_items)))
+            out.append(('', '\n'))
+        else:
+            out.append(('', out_line + '\n'))
+    return out
@@ -0,0 +1,172 @@
+"""
+Background jobs for the REPL.
+
+A job runs a statement in a worker thread, so that the prompt stays
+responsive while it is running. Jobs are started with `%bg`, or
+automatically when a statement takes longer than
+`PythonRepl.auto_background_after` seconds.
+"""
+import ctypes
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+__all__ = ["Job", "JobManager"]
+
+
+class Job:
+    """
+    Statement running in a worker thread.
+
+    :param source: The source code, for display.
+    :param func: Callable that executes the statement and returns its result.
+    :param statement_index: `current_statement_index` of the statement.
+    :param on_done: Called from the worker thread with this job, when it
+        finishes, but only after it got a number from the `JobManager`.
+    """
+
+    def __init__(
+        self,
+        source: str,
+        func: Callable[[], Any],
+        statement_index: int,
+        on_done: Callable[["Job"], None],
+    ) -> None:
+        self.source = source
+        self.func = func
+        self.statement_index = statement_index
+        self.on_done = on_done
+
+        #: Job number. `None` as long as the job is not in the jobs table.
+        self.number: Optional[int] = None
+
+        self.result: Any = None
+        self.exception: Optional[BaseException] = None
+        self.killed = False
+
+        # Wall time and CPU time (of this thread) in nanoseconds, and the
+        # change in allocated memory blocks (of the whole process).
+        self.start_time = time.perf_counter_ns()
+        self.wall: Optional[int] = None
+        self.cpu: Optional[int] = None
+        self.blocks: Optional[int] = None
+
+        self._done = threading.Event()
+        self._finishing = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(
+            target=self._run, name="ptpython-job", daemon=True
+        )
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def _run(self) -> None:
+        cpu0 = time.thread_time_ns()
+        blocks0 = sys.getallocatedblocks()
+        try:
+            try:
+                self.result = self.func()
+            except BaseException as e:
+                self.exception = e
+            finally:
+                # No `kill` after this, and drop one that came too late.
+                with self._lock:
+                    self._finishing = True
+                    _set_async_exc(threading.get_ident(), None)
+
+            self.wall = time.perf_counter_ns() - self.start_time
+            self.cpu = time.thread_time_ns() - cpu0
+            self.blocks = sys.getallocatedblocks() - blocks0
+        finally:
+            # (Also when a late `kill` interrupted the above, so that the job
+            # doesn't stay running.)
+            with self._lock:
+                self._done.set()
+                notify = self.number is not None
+        if notify:
+            self.on_done(self)
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    @property
+    def status(self) -> str:
+        if not self.done:
+            return "running"
+        if self.killed and isinstance(self.exception, KeyboardInterrupt):
+            return "killed"
+        if self.exception is not None:
+            return "failed"
+        return "done"
+
+    @property
+    def elapsed(self) -> int:
+        " Wall time in nanoseconds, up to now for running jobs. "
+        if self.wall is not None:
+            return self.wall
+        return time.perf_counter_ns() - self.start_time
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until the job finishes. Return `False` on timeout.
+        """
+        return self._done.wait(timeout)
+
+    def kill(self) -> None:
+        """
+        Raise `KeyboardInterrupt` in the worker thread. This happens as soon
+        as the thread executes Python code again, so a blocking call into a C
+        extension is not interrupted until it returns.
+        """
+        thread_id = self._thread.ident
+        with self._lock:
+            if self._finishing or thread_id is None:
+                return
+            self.killed = True
+            _set_async_exc(thread_id, KeyboardInterrupt)
+
+
+class JobManager:
+    """
+    Table of the jobs that were moved to the background.
+    """
+
+    def __init__(self) -> None:
+        self.jobs: Dict[int, Job] = {}
+        self._next_number = 1
+
+    def add(self, job: Job) -> int:
+        """
+        Give the job a number and add it to the table. If the job finished in
+        the meantime, `on_done` is called right away.
+        """
+        with job._lock:
+            job.number = self._next_number
+            self._next_number += 1
+            self.jobs[job.number] = job
+            notify = job.done
+        if notify:
+            job.on_done(job)
+        return job.number
+
+    def get(self, number: int) -> Job:
+        " Return job by number. Raises `KeyError` for unknown numbers. "
+        return self.jobs[number]
+
+    @property
+    def running(self) -> List[Job]:
+        return [job for job in self.jobs.values() if not job.done]
+
+
+def _set_async_exc(thread_id: int, exception: Optional[type]) -> None:
+    """
+    Raise `exception` in the thread, as soon as it executes Python code. With
+    `None`, an exception that is still pending is cancelled.
+    """
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(
+        ctypes.c_ulong(thread_id),
+        ctypes.py_object(exception) if exception is not None else None,
+    )
@@ -0,0 +1,415 @@
+"""
+Out-of-process execution for the REPL.
+
+In kernel mode, the code typed at the prompt is executed in a child process,
+the kernel. Completion and signature lookups are sent to the kernel as well,
+because that's where the namespace lives. The UI process only exchanges
+strings and formatted text with the kernel, so a statement that hogs the CPU
+or holds the GIL doesn't stall the UI, and the kernel can be restarted
+without losing the history or the settings of the REPL.
+
+::
+
+    %kernel start
+"""
+import builtins
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+from multiprocessing.connection import Listener
+from typing import Iterable, List, Optional, Tuple
+
+from prompt_toolkit.completion import CompleteEvent, Completion
+from prompt_toolkit.document import Document
+
+__all__ = ["Kernel", "KernelError"]
+
+#: Reply to an 'execute' request. `output` is the formatted result (a list of
+#: style/text tuples), or `None`. When the code raised an exception,
+#: `traceback` and `message` describe it. Timings as in `StatementTiming`.
+ExecuteReply = namedtuple(
+    "ExecuteReply", ("output", "traceback", "message", "wall", "cpu", "blocks")
+)
+
+
+class KernelError(Exception):
+    " Raised when the kernel is not running or died. "
+
+
+class Kernel:
+    """
+    Handle to the kernel process, used by the UI process.
+
+    The requests are synchronous. A lock makes sure that the completion
+    thread and the REPL don't talk to the kernel at the same time.
+    """
+
+    def __init__(self) -> None:
+        self.process: Optional[subprocess.Popen] = None
+        self._connection = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def start(self, timeout: float = 30) -> None:
+        """
+        Start the kernel process and wait until it connects.
+        """
+        authkey = os.urandom(32)
+
+        with Listener(authkey=authkey) as listener:
+            # Make sure this copy of ptpython is importable in the kernel.
+            package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            env = dict(
+                os.environ,
+                PYTHONPATH=os.pathsep.join(
+                    [package_dir] + os.environ.get("PYTHONPATH", "").split(os.pathsep)
+                ).rstrip(os.pathsep),
+                PTPYTHON_KERNEL_ADDRESS=repr(listener.address),
+                PTPYTHON_KERNEL_AUTHKEY=authkey.hex(),
+                PTPYTHON_KERNEL_PATH=os.pathsep.join(sys.path),
+            )
+            self.process = subprocess.Popen(
+                [sys.executable, "-c", "from ptpython.kernel import main; main()"],
+                env=env,
+                stdin=subprocess.DEVNULL,
+                # Don't receive the Ctrl-C from the terminal. We forward
+                # it, only when the kernel is executing code.
+                start_new_session=os.name != "nt",
+            )
+
+            # `accept` can't time out, so wait for it in a thread, and stop
+            # waiting when the kernel dies before connecting.
+            connections: List = []
+            accept_thread = threading.Thread(
+                target=lambda: connections.append(listener.accept()), daemon=True
+            )
+            accept_thread.start()
+            deadline = time.monotonic() + timeout
+            while accept_thread.is_alive():
+                accept_thread.join(0.05)
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    self.stop()
+                    raise KernelError("The kernel failed to start.")
+
+            self._connection = connections[0]
+
+    def stop(self) -> None:
+        " Terminate the kernel process. "
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+
+    def restart(self) -> None:
+        self.stop()
+        self.start()
+
+    def interrupt(self) -> None:
+        " Raise `KeyboardInterrupt` in the code that the kernel is executing. "
+        if self.process is not None and self.is_alive and os.name != "nt":
+            os.kill(self.process.pid, signal.SIGINT)
+
+    def _request(self, *message):
+        with self._lock:
+            if self._connection is None or not self.is_alive:
+                raise KernelError("The kernel is not running. Use %kernel restart.")
+            try:
+                self._connection.send(message)
+
+                # Forward Ctrl-C, and keep waiting for the reply.
+                while True:
+                    try:
+                        if self._connection.poll(0.05):
+                            break
+                    except KeyboardInterrupt:
+                        self.interrupt()
+                    if not self.is_alive:
+                        raise EOFError
+
+                return self._connection.recv()
+            except (EOFError, OSError):
+                # (The connection can be closed before the process ends.)
+                try:
+                    exit_code = self.process.wait(1)
+                except subprocess.TimeoutExpired:
+                    exit_code = None
+                if exit_code is not None and exit_code >= 0:
+                    # Like `exit()`. (Not killed by a signal.)
+                    message = "The kernel exited (exit code %s)."
+                else:
+                    message = "The kernel died (exit code %s)."
+                raise KernelError(message % exit_code + " Use %kernel restart.")
+
+    def execute(
+        self,
+        source: str,
+        statement_index: int,
+        width: int = 80,
+        history_limits: Optional[Tuple[Optional[int], Optional[int]]] = None,
+    ) -> ExecuteReply:
+        """
+        :param history_limits: `(max_entries, max_bytes)` for the output
+            history in the kernel, like in `OutputHistory`. (`None` keeps the
+            defaults.)
+        """
+        return self._request(
+            "execute", source, statement_index, os.getcwd(), width, history_limits
+        )
+
+    def get_completions(
+        self,
+        document: Document,
+        complete_event: CompleteEvent,
+        enable_dictionary_completion: bool,
+    ) -> Iterable[Completion]:
+        try:
+            completions = self._request(
+                "complete",
+                document.text,
+                document.cursor_position,
+                complete_event.completion_requested,
+                enable_dictionary_completion,
+            )
+        except KernelError:
+            return
+
+        for text, start_position, display, display_meta, style in completions:
+            yield Completion(
+                text,
+                start_position,
+                display=display,
+                display_meta=display_meta or None,
+                style=style,
+            )
+
+    def get_signatures(self, document: Document) -> List["Signature"]:
+        try:
+            return self._request("signatures", document.text, document.cursor_position)
+        except KernelError:
+            return []
+
+
+class Signature:
+    """
+    Picklable copy of the parts of a Jedi call signature that the layout
+    displays.
+    """
+
+    def __init__(self, full_name, params, index, bracket_start, docstring) -> None:
+        self.full_name = full_name
+        self.params = params
+        self.index = index
+        self.bracket_start = bracket_start
+        self._docstring = docstring
+
+    def docstring(self) -> str:
+        return self._docstring
+
+
+class Param:
+    def __init__(self, description: str) -> None:
+        self.description = description
+
+
+def main() -> None:
+    """
+    Entry point of the kernel process.
+    """
+    from ast import literal_eval
+    from multiprocessing.connection import Client
+
+    sys.path[:] = os.environ["PTPYTHON_KERNEL_PATH"].split(os.pathsep)
+    connection = Client(
+        literal_eval(os.environ["PTPYTHON_KERNEL_ADDRESS"]),
+        authkey=bytes.fromhex(os.environ["PTPYTHON_KERNEL_AUTHKEY"]),
+    )
+    _KernelServer(connection).serve()
+
+
+class _KernelServer:
+    """
+    Executes the requests in the kernel process.
+    """
+
+    def __init__(self, connection) -> None:
+        from .code_cache import CodeCache
+        from .completer import PythonCompleter
+        from .formatter import PtPyFormatter
+        from .output_history import OutputHistory
+        from .user_loop import UserEventLoop
+
+        self.connection = connection
+        self.namespace = {
+            "__name__": "__main__",
+            "__package__": None,
+            "__doc__": None,
+            "__builtins__": builtins,
+        }
+        self.code_cache = CodeCache()
+        self.formatter = PtPyFormatter()
+        self.output_history = OutputHistory(lambda: self.namespace)
+        self.user_loop = UserEventLoop()
+
+        self.enable_dictionary_completion = False
+        self.execute_count = 0
+        self.completer = PythonCompleter(
+            lambda: self.namespace,
+            lambda: self.namespace,
+            lambda: self.enable_dictionary_completion,
+            get_namespace_version=lambda: self.execute_count,
+        )
+
+    def serve(self) -> None:
+        from .utils import warm_up_jedi
+
+        # Ctrl-C is only forwarded while executing code.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        # Make the first completion fast.
+        threading.Thread(
+            target=warm_up_jedi,
+            args=(self.namespace, self.namespace),
+            name="ptpython-jedi-warm-up",
+            daemon=True,
+        ).start()
+
+        while True:
+            try:
+                command, *args = self.connection.recv()
+            except EOFError:
+                return
+            self.connection.send(getattr(self, "_" + command)(*args))
+
+    def _execute(
+        self,
+        source: str,
+        statement_index: int,
+        cwd: str,
+        width: int,
+        history_limits: Optional[Tuple[Optional[int], Optional[int]]],
+    ) -> ExecuteReply:
+        import inspect
+
+        from prompt_toolkit.formatted_text import to_formatted_text
+
+        from .code_cache import LAST_EXPR
+        from .repl import format_traceback
+        from .utils import get_compiler_flags
+
+        if os.getcwd() != cwd:
+            os.chdir(cwd)
+        self.execute_count += 1
+
+        def run_code(code):
+            result = eval(code, self.namespace)
+            if code.co_flags & inspect.CO_COROUTINE:
+                result = self.user_loop.run(result)
+            return result
+
+        clock0 = time.perf_counter_ns()
+        cpu0 = time.process_time_ns()
+        blocks0 = sys.getallocatedblocks()
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        try:
+            body_code, expression_code = self.code_cache.compile(
+                source, "<stdin>", LAST_EXPR, get_compiler_flags(self.namespace)
+            )
+            self.output_history.use_names(statement_index, body_code, expression_code)
+            if body_code is not None:
+                run_code(body_code)
+            result = None
+            if expression_code is not None:
+                result = run_code(expression_code)
+                history = self.output_history
+                if history_limits is not None:
+                    history.max_entries, history.max_bytes = history_limits
+                history.add(statement_index, result)
+
+            output = None
+            if result is not None:
+                self.formatter.width = width
+                output = [
+                    (style, text)
+                    for style, text, *_ in to_formatted_text(
+                        self.formatter.format(result)
+                    )
+                ]
+            tb_str = message = None
+        except SystemExit:
+            # Stop the kernel, like `exit()` stops the REPL. The UI process
+            # notices when the connection is closed.
+            raise
+        except BaseException as e:
+            output = None
+            tb_str = format_traceback(*sys.exc_info())
+            message = f"Stopped for exception: {e}"
+        finally:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        # Keep the order of the output in the terminal.
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        return ExecuteReply(
+            output,
+            tb_str,
+            message,
+            time.perf_counter_ns() - clock0,
+            time.process_time_ns() - cpu0,
+            sys.getallocatedblocks() - blocks0,
+        )
+
+    def _complete(
+        self,
+        text: str,
+        cursor_position: int,
+        completion_requested: bool,
+        enable_dictionary_completion: bool,
+    ):
+        self.enable_dictionary_completion = enable_dictionary_completion
+        completions = self.completer.get_completions(
+            Document(text, cursor_position),
+            CompleteEvent(completion_requested=completion_requested),
+        )
+        try:
+            return [
+                (c.text, c.start_position, c.display_text, c.display_meta_text, c.style)
+                for c in completions
+            ]
+        except Exception:
+            return []
+
+    def _signatures(self, text: str, cursor_position: int) -> List[Signature]:
+        from .utils import get_jedi_signatures
+
+        result = []
+        for sig in get_jedi_signatures(
+            Document(text, cursor_position), self.namespace, self.namespace
+        ):
+            try:
+                docstring = sig.docstring()
+                if not isinstance(docstring, str):
+                    docstring = docstring.decode("utf-8")
+                result.append(
+                    Signature(
+                        sig.full_name,
+                        [Param(str(p.description) if p else "*") for p in sig.params],
+                        getattr(sig, "index", 0),
+                        sig.bracket_start,
+                        docstring,
+                    )
+                )
+            except Exception:
+                # See the workarounds for Jedi in `signature_toolbar`.
+                pass
+        return result
@@ -3,17 +3,24 @@ Handles magic commands in a Python repl.
 
 ::
 """
+import ast
+import cProfile
 import os
+import pstats
 import sys
+import threading
 import traceback
 import warnings
 import shlex
 import pdb
 from functools import partial
+from itertools import chain
 import time
 import re
 from collections import namedtuple
 import inspect
+import statistics
+import timeit as timeit_module
 
 from prompt_toolkit.document import Document
 from prompt_toolkit.formatted_text import (
@@ -38,8 +45,12 @@ from prompt_toolkit.completion import (
 )
 
 
+from .code_cache import LAST_EXPR
 from .completer import Completer
-from .formatter import strip, display_object, PtPyFormatter
+from .formatter import strip, display_object, PtPyFormatter, _format_size
+from .kernel import Kernel, KernelError
+from .layout import _format_time
+from .sampler import Sampler
 
 class MagicHandler:
 
@@ -50,9 +61,17 @@ class MagicHandler:
         assert methods == set(MagicCompleter.magics), 'Methods in MagicHandler and dictionary in MagicCompleter are out of sync'
 
     def run_command(self, line):
-        args = shlex.split(line)
-        cmd = args.pop(0)
+        cmd, _, rest = line.strip().partition(' ')
+        if cmd in MagicCompleter.raw_magics:
+            # These magics take Python code, which shlex would mangle.
+            args = [rest.strip()] if rest.strip() else []
+        else:
+            args = shlex.split(rest)
         if cmd in MagicCompleter.magics:
+            if self.repl.kernel is not None and cmd in MagicCompleter.local_magics:
+                self.repl.print_error_message(
+                    f'The kernel runs the code in another process. Use %kernel stop to use %{cmd} here.')
+                return
             getattr(self, cmd)(*args)
         else:
             self.repl.print_error_message(
@@ -75,7 +94,8 @@ class MagicHandler:
             if not os.path.exists(arg) and os.path.exists(alt):
                 arg = alt
             try:
-                code = compile(open(arg, 'rt').read(), arg, 'exec')
+                with open(arg, 'rt') as f:
+                    code = self.repl.code_cache.compile(f.read(), arg, 'exec')
             except Exception as ex:
                 self.repl.handle_exception(ex, store_traceback=False)
                 return
@@ -135,11 +155,16 @@ class MagicHandler:
         self.repl.output_text(strip(FormattedText(out)))
 
     def pp(self, *args):
+        evaluate_properties = args[:1] == ('-p',)
+        if evaluate_properties:
+            args = args[1:]
         if len(args) == 0:
             self.repl.print_error_message('Invalid command. Usage:\n')
-            self.repl.output_text(MagicCompleter.get_magics_help('cd'))
+            self.repl.output_text(MagicCompleter.get_magics_help('pp'))
             return
         F = PtPyFormatter()
+        F.evaluate_properties = evaluate_properties
+        F.width = self.repl.app.output.get_size().columns
         for a in args:
             try:
                 code = compile(a, "argument", mode="eval")
@@ -148,6 +173,433 @@ class MagicHandler:
             except Exception as ex:
                 self.repl.print_error_message(f'Failed to pretty print {a}: {ex}')
 
+    def timeit(self, *args):
+        try:
+            number, repeat, enable_gc, stmt = self._parse_timeit_args(args)
+        except ValueError:
+            self.repl.print_error_message('Invalid command. Usage:\n')
+            self.repl.output_text(MagicCompleter.get_magics_help('timeit'))
+            return
+
+        # `Timer` runs the statement in a function, which only sees globals.
+        namespace = self.repl.get_globals()
+        if self.repl.get_locals() is not namespace:
+            namespace = dict(namespace, **self.repl.get_locals())
+
+        # `Timer` always disables the garbage collector, unless the setup
+        # enables it again.
+        timer = timeit_module.Timer(
+            stmt,
+            setup='import gc; gc.enable()' if enable_gc else 'pass',
+            globals=namespace,
+        )
+        try:
+            if number == 0:
+                # Calibrate: increase the loop count until a batch takes at
+                # least 0.2 seconds.
+                number, _ = timer.autorange()
+            timings = [t / number * 1e9 for t in timer.repeat(repeat, number)]
+        except Exception as ex:
+            self.repl.handle_exception(ex)
+            return
+
+        def fmt(t):
+            return ('class:pygments.number', _format_time(round(t)))
+
+        stdev = statistics.stdev(timings) if len(timings) > 1 else 0
+        self.repl.output_text(FormattedText([
+            ('', 'min '), fmt(min(timings)),
+            ('', ', median '), fmt(statistics.median(timings)),
+            ('', ', mean '), fmt(statistics.mean(timings)),
+            ('', ' ± '), fmt(stdev),
+            ('', ' per loop '),
+            ('class:gray', f'({repeat} runs, {number} loops each'
+                f'{", GC enabled" if enable_gc else ""})'),
+            ]))
+
+    def timings(self, *args):
+        try:
+            count = int(args[0]) if args else 10
+        except ValueError:
+            self.repl.print_error_message('Invalid command. Usage:\n')
+            self.repl.output_text(MagicCompleter.get_magics_help('timings'))
+            return
+        history = list(self.repl.timings)
+        if not history:
+            self.repl.print_error_message('No statements timed yet')
+            return
+
+        out = []
+        for t in sorted(history, key=lambda t: t.wall, reverse=True)[:count]:
+            source = t.source.strip().splitlines()[0]
+            if len(source) > 60 or '\n' in t.source.strip():
+                source = source[:57] + '...'
+            out.extend([
+                ('class:pygments.name.variable', f'{t.index:>6} '),
+                ('class:pygments.number', f'{_format_time(t.wall):>9} '),
+                ('class:gray', 'cpu '), ('class:pygments.number', f'{_format_time(t.cpu):>9} '),
+                ('class:gray', 'blocks '), ('class:pygments.number', f'{t.blocks:>+9} '),
+                ('', f' {source}\n'),
+            ])
+
+        walls = sorted(t.wall for t in history)
+        out.append(('class:gray', f'{len(walls)} statements: '))
+        for p in (50, 95, 99):
+            out.extend([
+                ('', f'p{p} '), ('class:pygments.number', _format_time(_percentile(walls, p))),
+                ('', '  '),
+            ])
+        self.repl.output_text(strip(FormattedText(out)))
+
+    def outmem(self, *args):
+        history = self.repl.output_history
+        entries = sorted(history, key=lambda e: e.size, reverse=True)
+        if not entries:
+            self.repl.print_error_message('No results stored')
+            return
+
+        out = []
+        for entry in entries:
+            if not entry.evicted:
+                status = f'last used in {entry.last_used}'
+            else:
+                status = 'evicted, still alive (weak reference)'
+            out.extend([
+                ('class:pygments.name.variable', f'{"_%i" % entry.index:>7} '),
+                ('class:pygments.number', f'{_format_size(entry.size):>10} '),
+                ('class:pygments.name.class', f' {entry.type_name:<20} '),
+                ('class:gray' if entry.evicted else '', f' {status}\n'),
+            ])
+
+        limit = lambda value, text: f' of {text}' if value is not None else ''
+        out.extend([
+            ('class:gray', f'{len(history)} results: '),
+            ('class:pygments.number', _format_size(history.total_size)),
+            ('class:gray', limit(history.max_bytes, _format_size(history.max_bytes or 0)) + ', '),
+            ('class:pygments.number', str(len(history))),
+            ('class:gray', limit(history.max_entries, f'{history.max_entries} results')),
+        ])
+        self.repl.output_text(strip(FormattedText(out)))
+
+    def bg(self, *args):
+        if len(args) == 0:
+            self.repl.print_error_message('Invalid command. Usage:\n')
+            self.repl.output_text(MagicCompleter.get_magics_help('bg'))
+            return
+        try:
+            job = self.repl.start_job(args[0])
+        except Exception as ex:
+            self.repl.handle_exception(ex, store_traceback=False)
+            return
+        number = self.repl.jobs.add(job)
+        self.repl.output_text(FormattedText([
+            ('class:gray', f'[{number}] Started. The result will be stored in _bg{number}.'),
+            ]))
+
+    def jobs(self, *args):
+        jobs = self.repl.jobs.jobs
+        if not jobs:
+            self.repl.print_error_message('No background jobs')
+            return
+        out = []
+        for number, job in jobs.items():
+            source = job.source.strip().splitlines()[0]
+            out.extend([
+                ('class:pygments.name.variable', f'[{number}] '),
+                ('class:pygments.keyword' if job.status == 'running' else 'class:gray', f'{job.status:<8} '),
+                ('class:pygments.number', f'{_format_time(job.elapsed):>9} '),
+                ('', f' {source}\n'),
+            ])
+        self.repl.output_text(strip(FormattedText(out)))
+
+    def _get_jobs(self, args, cmd):
+        " Look up the jobs for a list of job numbers. Return `None` if invalid. "
+        try:
+            return [self.repl.jobs.get(int(a.lstrip('%'))) for a in args]
+        except (ValueError, KeyError):
+            self.repl.print_error_message('Invalid job number. Usage:\n')
+            self.repl.output_text(MagicCompleter.get_magics_help(cmd))
+            return None
+
+    def wait(self, *args):
+        jobs = self._get_jobs(args, 'wait') if args else self.repl.jobs.running
+        if jobs is None:
+            return
+        for job in jobs:
+            # Ctrl-C only stops waiting, the job keeps running.
+            job.wait()
+        self.repl.report_finished_jobs()
+        if len(jobs) == 1:
+            self.repl.show_job(jobs[0])
+
+    def kill(self, *args):
+        jobs = self._get_jobs(args, 'kill')
+        if not jobs:
+            if jobs is not None:
+                self.repl.print_error_message('Invalid command. Usage:\n')
+                self.repl.output_text(MagicCompleter.get_magics_help('kill'))
+            return
+        for job in jobs:
+            job.kill()
+
+    def prun(self, *args):
+        try:
+            if len(args) != 1:
+                raise ValueError
+            options, stmt = _split_options(args[0], valued='slmD')
+            sort = options.get('s', ['cumulative'])[-1]
+            limit = int(options.get('l', [20])[-1])
+            if sort not in _PRUN_SORT_KEYS or limit < 1 or not stmt:
+                raise ValueError
+        except ValueError:
+            self.repl.print_error_message('Invalid command. Usage:\n')
+            self.repl.output_text(MagicCompleter.get_magics_help('prun'))
+            return
+
+        # cProfile only sees the current thread, so top-level `await` (which
+        # runs in the user loop) can't be profiled.
+        flags = self.repl.get_compiler_flags() & ~getattr(ast, 'PyCF_ALLOW_TOP_LEVEL_AWAIT', 0)
+        profile = cProfile.Profile()
+        interrupted = False
+        try:
+            code = self.repl.code_cache.compile(stmt, '<stdin>', 'exec', flags)
+        except Exception as ex:
+            self.repl.handle_exception(ex, store_traceback=False)
+            return
+        try:
+            profile.runctx(code, self.repl.get_globals(), self.repl.get_locals())
+        except KeyboardInterrupt:
+            # Still show where the time went until now.
+            interrupted = True
+        except Exception as ex:
+            self.repl.handle_exception(ex)
+            return
+
+        for filename in options.get('D', []):
+            try:
+                profile.dump_stats(filename)
+            except OSError as ex:
+                self.repl.print_error_message(f'Failed to write {filename}: {ex}')
+
+        stats = pstats.Stats(profile)
+        modules = options.get('m', [])
+        entries = [
+            (func, cc, nc, tt, ct)
+            for func, (cc, nc, tt, ct, _) in stats.stats.items()
+            if not modules or _in_modules(func, modules)
+        ]
+        entries.sort(key=_PRUN_SORT_KEYS[sort], reverse=sort != 'name')
+
+        def fmt(t):
+            return ('class:pygments.number', f'{_format_time(round(t * 1e9)):>9} ')
+
+        out = [
+            ('class:gray', 'Interrupted. ' if interrupted else ''),
+            ('', f'{stats.total_calls} function calls ({stats.prim_calls} primitive) in '),
+            ('class:pygments.number', _format_time(round(stats.total_tt * 1e9))),
+            ('class:gray', f', sorted by {sort}'
+                + (f', in {", ".join(modules)}' if modules else '') + '\n'),
+            ('class:gray', f'{"ncalls":>12} {"tottime":>9} {"percall":>9} {"cumtime":>9} {"percall":>9}  function\n'),
+        ]
+        for (filename, line, name), cc, nc, tt, ct in entries[:limit]:
+            calls = str(nc) if nc == cc else f'{nc}/{cc}'
+            out.extend([
+                ('class:pygments.name.variable', f'{calls:>12} '),
+                fmt(tt), fmt(tt / nc if nc else 0),
+                fmt(ct), fmt(ct / cc if cc else 0),
+                ('class:pygments.name.function', f' {name}'),
+                ('class:gray', f' {os.path.basename(filename)}:{line}' if filename != '~' else ''),
+                ('', '\n'),
+            ])
+        self.repl.output_text(strip(FormattedText(out)))
+
+    def sample(self, *args):
+        try:
+            if len(args) != 1:
+                raise ValueError
+            options, stmt = _split_options(args[0], flags='a', valued='ro')
+            rate = float(options.get('r', [200])[-1])
+            if rate <= 0 or not stmt:
+                raise ValueError
+        except ValueError:
+            self.repl.print_error_message('Invalid command. Usage:\n')
+            self.repl.output_text(MagicCompleter.get_magics_help('sample'))
+            return
+
+        repl = self.repl
+
+        # The statement runs right here, in the sampled thread: not as a job
+        # (`auto_background_after`), nor in the user loop (top-level `await`).
+        flags = repl.get_compiler_flags() & ~getattr(ast, 'PyCF_ALLOW_TOP_LEVEL_AWAIT', 0)
+        try:
+            codes = repl.code_cache.compile(stmt, '<stdin>', LAST_EXPR, flags)
+        except Exception as ex:
+            repl.handle_exception(ex, store_traceback=False)
+            return
+        repl.output_history.use_names(repl.current_statement_index, *codes)
+        run = repl._make_runner(*codes)
+
+        # The stacks start below `run`. The sampler is stopped before the
+        # result is shown, so that waiting for the formatter isn't sampled.
+        sampler = Sampler(
+            rate,
+            thread_ids=None if 'a' in options else {threading.get_ident()},
+            root=run.__code__,
+            root_thread_id=threading.get_ident(),
+            filename='<stdin>',
+        )
+        sampler.start()
+        try:
+            result = run()
+        finally:
+            sampler.stop()
+            self._report_samples(sampler, stmt, options.get('o', []))
+
+        if codes[1] is not None:
+            repl.output_history.add(repl.current_statement_index, result)
+            if result is not None:
+                repl._show_result(result)
+
+    def _report_samples(self, sampler, stmt, filenames):
+        total = sum(sampler.stacks.values())
+        if not total:
+            self.repl.print_error_message('No samples. Try a higher rate with -r.')
+            return
+        out = [
+            ('class:gray', f'{sampler.sample_count} samples at {sampler.rate:g}/s. Top of stack:\n'),
+            ('class:gray', f'{"self":>7} {"total":>7}  function\n'),
+        ]
+        for name, own, inclusive in sampler.top_of_stack()[:10]:
+            out.extend([
+                ('class:pygments.number', f'{100 * own / total:>6.1f}% {100 * inclusive / total:>6.1f}% '),
+                ('class:pygments.name.function', f' {name}\n'),
+            ])
+        self.repl.output_text(strip(FormattedText(out)))
+
+        for filename in filenames:
+            try:
+                if filename.endswith('.svg'):
+                    sampler.write_svg(filename, title=stmt)
+                else:
+                    sampler.write_folded(filename)
+            except OSError as ex:
+                self.repl.print_error_message(f'Failed to write {filename}: {ex}')
+            else:
+                self.repl.output_text(FormattedText([('class:gray', f'Wrote {filename}')]))
+
+    def hexdump(self, *args):
+        try:
+            if len(args) != 1:
+                raise ValueError
+            options, expression = _split_options(args[0], valued='on')
+            offset = int(options.get('o', ['0'])[-1], 0)
+            length = int(options['n'][-1], 0) if 'n' in options else None
+            if offset < 0 or (length is not None and length < 0) or not expression:
+                raise ValueError
+        except ValueError:
+            self.repl.print_error_message('Invalid command. Usage:\n')
+            self.repl.output_text(MagicCompleter.get_magics_help('hexdump'))
+            return
+        try:
+            result = eval(expression, self.repl.get_globals(), self.repl.get_locals())
+            chunks = self.repl.formatter.iter_hexdump(result, offset, length)
+            first_chunk = next(chunks)
+        except Exception as ex:
+            self.repl.print_error_message(f'Failed to hexdump {expression}: {ex}')
+            return
+        self.repl._display_output(chain([first_chunk], chunks))
+
+    def more(self, *args):
+        self.repl.show_more()
+
+    def kernel(self, *args):
+        action = args[0] if len(args) == 1 else 'status' if not args else None
+        repl = self.repl
+        if action in ('start', 'restart'):
+            if repl.kernel is not None:
+                repl.kernel.stop()
+                repl.kernel = None
+            kernel = Kernel()
+            try:
+                kernel.start()
+            except KernelError as ex:
+                self.repl.print_error_message(str(ex))
+                return
+            repl.kernel = kernel
+        elif action == 'stop':
+            if repl.kernel is not None:
+                repl.kernel.stop()
+                repl.kernel = None
+        elif action != 'status':
+            self.repl.print_error_message('Invalid command. Usage:\n')
+            self.repl.output_text(MagicCompleter.get_magics_help('kernel'))
+            return
+
+        if repl.kernel is None:
+            status = 'Code is executed in this process.'
+        elif repl.kernel.is_alive:
+            status = f'Code is executed in the kernel (pid {repl.kernel.process.pid}).'
+        else:
+            status = 'The kernel died. Use %kernel restart.'
+        self.repl.output_text(FormattedText([('class:gray', status)]))
+
+    @staticmethod
+    def _parse_timeit_args(args):
+        """
+        Split `[-n LOOPS] [-r REPEAT] [-g] STATEMENT` into its parts.
+        A loop count of 0 means: calibrate automatically.
+        """
+        if len(args) != 1:
+            raise ValueError
+        options, stmt = _split_options(args[0], flags='g', valued='nr')
+        number = int(options.get('n', [0])[-1])
+        repeat = int(options.get('r', [7])[-1])
+        if number < 0 or repeat < 1 or not stmt:
+            raise ValueError
+        return number, repeat, 'g' in options, stmt
+
+def _split_options(text, flags='', valued=''):
+    """
+    Split the leading options, like `-n 10 -g`, off the code of a raw magic.
+    Return a dict from option letter to the list of its values (`True` for
+    the `flags`, a string for the `valued` options), and the code.
+    """
+    options = {}
+    while True:
+        option, _, rest = text.partition(' ')
+        if len(option) != 2 or option[0] != '-':
+            break
+        if option[1] in flags:
+            options.setdefault(option[1], []).append(True)
+        elif option[1] in valued:
+            value, _, rest = rest.lstrip().partition(' ')
+            if not value:
+                raise ValueError
+            options.setdefault(option[1], []).append(value)
+        else:
+            break
+        text = rest.lstrip()
+    return options, text
+
+#: Sort orders of %prun, for `(function, primitive calls, calls, tottime,
+#: cumtime)` tuples.
+_PRUN_SORT_KEYS = {
+    'cumulative': lambda e: e[4],
+    'tottime': lambda e: e[3],
+    'ncalls': lambda e: e[2],
+    'name': lambda e: e[0][2],
+}
+
+def _in_modules(func, modules):
+    " Whether a pstats function key is defined in one of the modules. "
+    filename = func[0]
+    return any(m in filename or m.replace('.', os.sep) in filename for m in modules)
+
+def _percentile(sorted_values, p):
+    " Nearest-rank percentile of a sorted, non-empty list. "
+    rank = max(1, -(-p * len(sorted_values) // 100))
+    return sorted_values[rank - 1]
+
 class MagicCompleter(Completer):
     magic_tuple = namedtuple('magic_tuple', ('grammar', 'usage', 'help'))
     magics = {
@@ -162,9 +614,38 @@ class MagicCompleter(Completer):
             'oct' : magic_tuple('', '', 'Display integers as octal'),
             'simple' : magic_tuple('', '', 'Display output with default Python repr'),
             'pretty' : magic_tuple('', '', 'Display output with pretty alternative repr'),
-            'pp' : magic_tuple(r'(\s+ (?P<python>))+', 'OBJECT ...', 'Display each OBJECT in argument list with pretty alternative repr'),
+            'pp' : magic_tuple(r'(\s+ -p)? (\s+ (?P<python>))+', '[-p] OBJECT ...',
+                'Display each OBJECT in argument list with pretty alternative repr. -p evaluates properties and other descriptors'),
+            'timeit' : magic_tuple(r'(\s+ -[nr] \s+ [0-9]+ | \s+ -g)* \s+ (?P<python>.+)', '[-n LOOPS] [-r REPEAT] [-g] STATEMENT',
+                'Time STATEMENT in the current namespace: REPEAT (default: 7) batches of LOOPS (default: calibrated) loops. -g keeps the garbage collector enabled'),
+            'timings' : magic_tuple('', '[COUNT]', 'List the COUNT (default: 10) slowest statements of this session, and the p50/p95/p99 of all'),
+            'outmem' : magic_tuple('', '', 'List the results in _N with their estimated memory. Beyond the limits of repl.output_history, the least recently used are evicted'),
+            'bg' : magic_tuple(r'\s+ (?P<python>.+)', 'STATEMENT', 'Run STATEMENT in a background thread, and store its result in _bgN'),
+            'jobs' : magic_tuple('', '', 'List the background jobs'),
+            'wait' : magic_tuple('', '[JOB ...]', 'Wait for background JOBs (default: all running jobs) and show the result'),
+            'kill' : magic_tuple('', 'JOB ...', 'Interrupt background JOBs with KeyboardInterrupt, once they run Python code again'),
+            'prun' : magic_tuple(r'(\s+ -[slm] \s+ [^\s]+ | \s+ -D \s+ (?P<filename>[^\s]+))* \s+ (?P<python>.+)',
+                '[-s cumulative|tottime|ncalls|name] [-l LIMIT] [-m MODULE]... [-D FILE] STATEMENT',
+                'Profile STATEMENT with cProfile and list the LIMIT (default: 20) top functions, optionally only those in MODULEs. -D dumps the stats to a .pstats FILE'),
+            'sample' : magic_tuple(r'(\s+ -r \s+ [0-9.]+ | \s+ -a | \s+ -o \s+ (?P<filename>[^\s]+))* \s+ (?P<python>.+)',
+                '[-r RATE] [-a] [-o FILE] STATEMENT',
+                'Execute STATEMENT while sampling its stack RATE (default: 200) times per second, and show where it spent its time. -a samples all threads. -o writes the stacks to a folded FILE, or a flamegraph if FILE ends with .svg'),
+            'hexdump' : magic_tuple(r'(\s+ -[on] \s+ [0-9a-fA-Fx]+)* \s+ (?P<python>.+)', '[-o OFFSET] [-n LENGTH] EXPRESSION',
+                'Hexdump the LENGTH (default: all) bytes at OFFSET of EXPRESSION (bytes, bytearray, memoryview or mmap). Numbers can be hex (0x...)'),
+            'more' : magic_tuple('', '', 'Continue displaying the output that was truncated'),
+            'kernel' : magic_tuple(r'\s+ (start|restart|stop)', '[start|restart|stop]',
+                'Execute code and completion in a child process (the kernel), restart it or go back to this process. Magics still use the namespace of this process'),
             }
 
+    # Magics that receive the rest of the line as Python code, instead of
+    # shell-like arguments.
+    raw_magics = {'timeit', 'bg', 'prun', 'sample', 'hexdump'}
+
+    # Magics that run code or look at objects in the namespace of this
+    # process. With a kernel, the namespace is in the kernel process instead.
+    local_magics = {
+        'run', 'who', 'pp', 'timeit', 'bg', 'prun', 'sample', 'hexdump', 'outmem'}
+
     @classmethod
     def get_magics_help(cls, target_name=None):
         out = []
@@ -0,0 +1,235 @@
+"""
+Output history of the REPL: the results that are stored as `_N`.
+
+Every result is kept in the namespace until the history grows beyond
+`max_entries` results or beyond `max_bytes` of (estimated) memory. Then the
+results that weren't used for the longest time are removed from the
+namespace. Optionally, a weak reference to them is kept, so that `_N` comes
+back when the object is still alive because something else references it.
+
+A result is used when a statement refers to its `_N` name. That's found out
+from the names of the compiled code, so that the namespace can stay a plain
+dict.
+"""
+import sys
+import types
+import weakref
+from collections import OrderedDict
+from itertools import chain, islice
+from typing import Any, Callable, Dict, Iterator, Optional
+
+__all__ = ["OutputHistory", "estimate_size"]
+
+# Number of objects that one size estimate measures at most. The rest is
+# extrapolated from the items that were measured.
+MAX_SIZE_VISITS = 5000
+
+# Containers with more items than this are measured from a sample of their
+# items. (Smaller samples are taken when the visit budget runs low.)
+SAMPLE_SIZE = 100
+
+# Nesting level up to which contained objects are measured.
+MAX_SIZE_DEPTH = 8
+
+
+class _Entry:
+    __slots__ = ("index", "size", "type_name", "last_used", "value", "ref")
+
+    def __init__(self, index: int, value: Any, size: int) -> None:
+        self.index = index
+        self.size = size
+        self.type_name = type(value).__qualname__
+        self.last_used = index
+        #: The result, or `None` when it was evicted. Then, `ref` can be a
+        #: weak reference to it.
+        self.value = value
+        self.ref: Optional[weakref.ref] = None
+
+    @property
+    def evicted(self) -> bool:
+        return self.value is None
+
+
+class OutputHistory:
+    """
+    The results stored as `_N` in the namespace, with their estimated size,
+    in least recently used order.
+
+    :param get_namespace: Callable that returns the namespace of `_N`.
+    """
+
+    def __init__(self, get_namespace: Callable[[], Dict[str, Any]]) -> None:
+        self.get_namespace = get_namespace
+
+        # Limits. (None for no limit.) The last result is always kept.
+        self.max_entries: Optional[int] = 1000
+        self.max_bytes: Optional[int] = 512 * 1024 * 1024
+
+        # Keep a weak reference to evicted results, where the type allows it.
+        self.keep_weak_references = True
+
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._last_index: Optional[int] = None
+        self.total_size = 0
+
+    def add(self, index: int, result: Any) -> None:
+        " Store the result of statement `index` as `_` and `_index`. "
+        namespace = self.get_namespace()
+        namespace["_"] = namespace["_%i" % index] = result
+
+        old = self._entries.pop(index, None)
+        if old is not None and not old.evicted:
+            self.total_size -= old.size
+        if result is None:
+            return  # (Costs nothing, and `None` means evicted.)
+        entry = _Entry(index, result, estimate_size(result))
+        self._entries[index] = entry
+        self._last_index = index
+        self.total_size += entry.size
+        self._evict()
+
+    def use_names(self, statement_index: int, *codes) -> None:
+        """
+        Mark the results that the compiled `codes` refer to as used, before
+        they run, and put evicted results that are still alive back in the
+        namespace.
+        """
+        for name in chain.from_iterable(map(_code_names, codes)):
+            if not (name.startswith("_") and name[1:].isdigit()):
+                continue
+            entry = self._entries.get(int(name[1:]))
+            if entry is None:
+                continue
+            entry.last_used = statement_index
+            self._entries.move_to_end(entry.index)
+            if entry.evicted:
+                value = entry.ref() if entry.ref is not None else None
+                if value is not None:
+                    entry.value, entry.ref = value, None
+                    self.total_size += entry.size
+                    self.get_namespace()[name] = value
+        self._evict()
+
+    def _evict(self) -> None:
+        """
+        Evict the least recently used results, until the limits are met, and
+        forget the evicted results that are gone.
+        """
+        live = []
+        for entry in list(self._entries.values()):
+            if not entry.evicted:
+                live.append(entry)
+            elif entry.ref is None or entry.ref() is None:
+                del self._entries[entry.index]
+        count = len(live)
+        for entry in live:
+            if (self.max_entries is None or count <= self.max_entries) and (
+                self.max_bytes is None or self.total_size <= self.max_bytes
+            ):
+                break
+            if entry.index != self._last_index:  # It's still in `_` anyway.
+                self._evict_entry(entry)
+                count -= 1
+
+    def _evict_entry(self, entry: _Entry) -> None:
+        namespace = self.get_namespace()
+        name = "_%i" % entry.index
+        if namespace.get(name) is entry.value:
+            del namespace[name]
+        if self.keep_weak_references:
+            try:
+                entry.ref = weakref.ref(entry.value)
+            except TypeError:
+                pass  # Like lists and dicts.
+        entry.value = None
+        self.total_size -= entry.size
+
+    def __iter__(self) -> Iterator[_Entry]:
+        " Entries, least recently used first. "
+        return iter(list(self._entries.values()))
+
+    def __len__(self) -> int:
+        return sum(not e.evicted for e in self._entries.values())
+
+
+def _code_names(code) -> Iterator[str]:
+    " The global and local names of a code object and the code it contains. "
+    if code is None:
+        return
+    yield from code.co_names
+    yield from code.co_varnames
+    for const in code.co_consts:
+        if hasattr(const, "co_names"):
+            yield from _code_names(const)
+
+
+def estimate_size(o: Any) -> int:
+    """
+    Estimate the memory that `o` keeps alive: `sys.getsizeof` of it and of
+    the objects it contains, and the data of NumPy arrays and pandas objects.
+    Shared objects are counted once.
+
+    At most `MAX_SIZE_VISITS` objects are measured. Every container divides
+    what is left of that budget between a sample of its items, and the size
+    of the other items is extrapolated from the sample. Objects nested deeper
+    than `MAX_SIZE_DEPTH` are not counted.
+    """
+    seen = set()
+    numpy = sys.modules.get("numpy")
+    pandas = sys.modules.get("pandas")
+
+    def size(o: Any, depth: int, budget: int) -> float:
+        " Size of `o`, visiting at most `budget` objects. "
+        if id(o) in seen:
+            return 0
+        seen.add(id(o))
+
+        if numpy is not None and isinstance(o, numpy.ndarray):
+            # (For views, the base array is kept alive.)
+            base = o.base if isinstance(o.base, numpy.ndarray) else o
+            return sys.getsizeof(o) + (base.nbytes if base is not o else 0)
+        if pandas is not None and isinstance(o, (pandas.DataFrame, pandas.Series)):
+            # Without `deep`, strings in object columns count as pointers.
+            # (`sys.getsizeof` would measure them, which is slow.)
+            usage = o.memory_usage(index=True)
+            return int(usage.sum() if hasattr(usage, "sum") else usage)
+
+        total: float = sys.getsizeof(o, 0)
+        budget -= 1
+        if (
+            budget <= 0
+            or depth >= MAX_SIZE_DEPTH
+            or isinstance(o, (type, types.ModuleType, types.FunctionType))
+        ):
+            # (Classes and so on are kept alive elsewhere anyway.)
+            return total
+
+        if isinstance(o, (dict, list, tuple, set, frozenset)):
+            count = len(o)
+            if count == 0:
+                return total
+            # Balance breadth and depth: a big sample of shallow items, or a
+            # smaller one that is measured deeper.
+            sample_size = max(1, min(count, SAMPLE_SIZE, int(budget ** 0.5)))
+            item_budget = max(1, budget // sample_size)
+            if isinstance(o, dict):
+                sampled = sum(
+                    size(k, depth + 1, 1) + size(v, depth + 1, item_budget - 1)
+                    for k, v in islice(o.items(), sample_size)
+                )
+            else:
+                sampled = sum(
+                    size(item, depth + 1, item_budget)
+                    for item in islice(o, sample_size)
+                )
+            return total + sampled * count / sample_size
+
+        try:
+            instance_dict = object.__getattribute__(o, "__dict__")
+        except AttributeError:
+            return total
+        if isinstance(instance_dict, dict):
+            total += size(instance_dict, depth + 1, budget)
+        return total
+
+    return int(size(o, 0, MAX_SIZE_VISITS))
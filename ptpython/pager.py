@@ -0,0 +1,324 @@
+"""
+Full screen pager for results that don't fit in the terminal.
+
+The result is formatted lazily: `LazyLines` pulls chunks from
+`PtPyFormatter.iter_format` only when the pager needs more lines, so that
+opening a huge result is as fast as opening a small one. Like the history
+browser, it runs as a sub application of the Repl.
+"""
+from typing import Iterator, List, Optional, Tuple
+
+from prompt_toolkit.application import Application
+from prompt_toolkit.buffer import Buffer
+from prompt_toolkit.filters import Condition
+from prompt_toolkit.formatted_text.base import StyleAndTextTuples
+from prompt_toolkit.formatted_text.utils import fragment_list_to_text
+from prompt_toolkit.key_binding import KeyBindings
+from prompt_toolkit.layout.containers import ConditionalContainer, HSplit, Window
+from prompt_toolkit.layout.controls import BufferControl, FormattedTextControl
+from prompt_toolkit.layout.layout import Layout
+from prompt_toolkit.layout.processors import BeforeInput
+
+__all__ = ["LazyLines", "Pager"]
+
+# Maximum amount of new lines that a search formats, before it gives up.
+SEARCH_LIMIT = 100000
+
+
+class LazyLines:
+    """
+    Lines of a result, split in rows of at most `width` characters, that are
+    only formatted when they are requested.
+
+    :param chunks: Iterator of `(fragments, remaining_items)` tuples.
+    :param width: Terminal width.
+    """
+
+    def __init__(
+        self, chunks: Iterator[Tuple[StyleAndTextTuples, int]], width: int
+    ) -> None:
+        self._chunks = chunks
+        self.width = max(width, 1)
+
+        self.rows: List[StyleAndTextTuples] = []
+        #: For every row, whether it ends with a line break (or is wrapped).
+        self.hard_breaks: List[bool] = []
+        self.exhausted = False
+
+        self._current: StyleAndTextTuples = []
+        self._current_width = 0
+
+    def _end_row(self, hard: bool) -> None:
+        self.rows.append(self._current)
+        self.hard_breaks.append(hard)
+        self._current = []
+        self._current_width = 0
+
+    def _pull(self) -> None:
+        " Format the next chunk. "
+        try:
+            fragments, _ = next(self._chunks)
+        except StopIteration:
+            self.exhausted = True
+            if self._current:
+                self._end_row(hard=False)
+            return
+
+        for style, text, *_ in fragments:
+            for i, part in enumerate(text.split("\n")):
+                if i > 0:
+                    self._end_row(hard=True)
+                while part:
+                    space = self.width - self._current_width
+                    if space == 0:
+                        self._end_row(hard=False)
+                        continue
+                    self._current.append((style, part[:space]))
+                    self._current_width += len(part[:space])
+                    part = part[space:]
+
+    def ensure(self, count: int) -> int:
+        """
+        Format until there are at least `count` rows, or until the end of the
+        result. Return the amount of rows.
+        """
+        while len(self.rows) < count and not self.exhausted:
+            self._pull()
+        return len(self.rows)
+
+    def to_formatted_text(self) -> StyleAndTextTuples:
+        " All rows that were formatted, with the original line breaks. "
+        result: StyleAndTextTuples = []
+        for row, hard in zip(self.rows, self.hard_breaks):
+            result.extend(row)
+            if hard:
+                result.append(("", "\n"))
+        return result
+
+
+class Pager:
+    """
+    Create an `Application` for paging through a result.
+    This has to be run as a sub application of `python_input`.
+    """
+
+    def __init__(self, python_input, lines: LazyLines) -> None:
+        self.python_input = python_input
+        self.lines = lines
+
+        self.top = 0
+        self.search_text = ""
+        self.message = ""
+
+        # '/' while typing a search string, ':' while typing a line number.
+        self.input_mode: Optional[str] = None
+        self.input_buffer = Buffer(multiline=False, accept_handler=self._accept_input)
+
+        self.page_window = Window(
+            FormattedTextControl(self._get_page_fragments, focusable=True),
+            wrap_lines=False,
+        )
+        input_window = ConditionalContainer(
+            Window(
+                BufferControl(
+                    self.input_buffer,
+                    input_processors=[BeforeInput(lambda: self.input_mode or "")],
+                ),
+                height=1,
+            ),
+            filter=Condition(lambda: self.input_mode is not None),
+        )
+        status_window = Window(
+            FormattedTextControl(self._get_status_fragments),
+            height=1,
+            style="class:status-toolbar",
+        )
+
+        self.app: Application[None] = Application(
+            layout=Layout(HSplit([self.page_window, input_window, status_window])),
+            full_screen=True,
+            style=python_input._current_style,
+            key_bindings=self._create_key_bindings(),
+        )
+
+    @property
+    def page_height(self) -> int:
+        return max(1, self.app.output.get_size().rows - 1)
+
+    def scroll_to(self, top: int) -> None:
+        height = self.page_height
+        count = self.lines.ensure(top + height)
+        self.top = max(0, min(top, count - height))
+
+    def _get_page_fragments(self) -> StyleAndTextTuples:
+        height = self.page_height
+        self.lines.ensure(self.top + height)
+
+        result: StyleAndTextTuples = []
+        for row in self.lines.rows[self.top : self.top + height]:
+            result.extend(self._highlight(row))
+            result.append(("", "\n"))
+        return result[:-1]
+
+    def _highlight(self, row: StyleAndTextTuples) -> StyleAndTextTuples:
+        " Highlight the occurrences of the search string. "
+        if not self.search_text:
+            return row
+        text = fragment_list_to_text(row)
+        if self.search_text not in text:
+            return row
+
+        selected = [False] * len(text)
+        index = text.find(self.search_text)
+        while index != -1:
+            for i in range(index, index + len(self.search_text)):
+                selected[i] = True
+            index = text.find(self.search_text, index + 1)
+
+        result: StyleAndTextTuples = []
+        position = 0
+        for style, fragment_text, *_ in row:
+            for char in fragment_text:
+                result.append(
+                    (style + " reverse" if selected[position] else style, char)
+                )
+                position += 1
+        return result
+
+    def _get_status_fragments(self) -> StyleAndTextTuples:
+        count = len(self.lines.rows)
+        more = "" if self.lines.exhausted else "+"
+        last = min(self.top + self.page_height, count)
+        return [
+            ("class:status-toolbar", f" Lines {self.top + 1}-{last} of {count}{more} "),
+            ("class:status-toolbar", f" {self.message} " if self.message else ""),
+            (
+                "class:status-toolbar",
+                " [/] Search [n/N] Next/previous [:] Go to line [q] Quit ",
+            ),
+        ]
+
+    def search(self, backwards: bool = False) -> None:
+        """
+        Scroll to the next line that contains the search string. Searching
+        forward formats at most `SEARCH_LIMIT` new lines.
+        """
+        self.message = ""
+        if not self.search_text:
+            return
+
+        def matches(i: int) -> bool:
+            return self.search_text in fragment_list_to_text(self.lines.rows[i])
+
+        if backwards:
+            for i in range(self.top - 1, -1, -1):
+                if matches(i):
+                    self.scroll_to(i)
+                    return
+        else:
+            limit = len(self.lines.rows) + SEARCH_LIMIT
+            i = self.top + 1
+            while i < limit and self.lines.ensure(i + 1) > i:
+                if matches(i):
+                    self.scroll_to(i)
+                    return
+                i += 1
+            if not self.lines.exhausted:
+                self.message = (
+                    f"Not found in the next {SEARCH_LIMIT} lines (n continues)"
+                )
+                self.scroll_to(i)
+                return
+        self.message = f"Pattern not found: {self.search_text}"
+
+    def _accept_input(self, buff: Buffer) -> bool:
+        if self.input_mode == "/":
+            self.search_text = buff.text
+            self.search()
+        elif self.input_mode == ":":
+            try:
+                self.scroll_to(int(buff.text) - 1)
+                self.message = ""
+            except ValueError:
+                self.message = f"Invalid line number: {buff.text}"
+        self._leave_input_mode()
+        return False
+
+    def _enter_input_mode(self, mode: str) -> None:
+        self.input_mode = mode
+        self.input_buffer.reset()
+        self.app.layout.focus(self.input_buffer)
+
+    def _leave_input_mode(self) -> None:
+        self.input_mode = None
+        self.app.layout.focus(self.page_window)
+
+    def _create_key_bindings(self) -> KeyBindings:
+        bindings = KeyBindings()
+        handle = bindings.add
+        paging = Condition(lambda: self.input_mode is None)
+
+        @handle("q", filter=paging)
+        @handle("c-c", filter=paging)
+        @handle("escape", filter=paging)
+        def _(event):
+            " Quit. "
+            event.app.exit()
+
+        @handle("down", filter=paging)
+        @handle("j", filter=paging)
+        @handle("enter", filter=paging)
+        def _(event):
+            self.scroll_to(self.top + event.arg)
+
+        @handle("up", filter=paging)
+        @handle("k", filter=paging)
+        def _(event):
+            self.scroll_to(self.top - event.arg)
+
+        @handle("pagedown", filter=paging)
+        @handle(" ", filter=paging)
+        @handle("c-f", filter=paging)
+        def _(event):
+            self.scroll_to(self.top + self.page_height)
+
+        @handle("pageup", filter=paging)
+        @handle("b", filter=paging)
+        @handle("c-b", filter=paging)
+        def _(event):
+            self.scroll_to(self.top - self.page_height)
+
+        @handle("home", filter=paging)
+        @handle("g", filter=paging)
+        def _(event):
+            self.scroll_to(0)
+
+        @handle("end", filter=paging)
+        @handle("G", filter=paging)
+        def _(event):
+            " Go to the last line that was formatted until now. "
+            self.scroll_to(len(self.lines.rows))
+
+        @handle("/", filter=paging)
+        def _(event):
+            self._enter_input_mode("/")
+
+        @handle(":", filter=paging)
+        def _(event):
+            self._enter_input_mode(":")
+
+        @handle("n", filter=paging)
+        def _(event):
+            self.search()
+
+        @handle("N", filter=paging)
+        def _(event):
+            self.search(backwards=True)
+
+        @handle("c-c", filter=~paging)
+        @handle("escape", filter=~paging, eager=True)
+        def _(event):
+            " Cancel input. "
+            self._leave_input_mode()
+
+        return bindings
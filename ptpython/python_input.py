@@ -2,8 +2,7 @@
 Application for reading Python input.
 This can be used for creation of Python REPLs.
 """
-import __future__
-
+import threading
 from asyncio import get_event_loop
 from functools import partial
 from typing import Any, Callable, Dict, Generic, List, Optional, TypeVar
@@ -51,8 +50,10 @@ from prompt_toolkit.utils import is_windows
 from prompt_toolkit.validation import ConditionalValidator, Validator
 from pygments.lexers import Python3Lexer as PythonLexer
 
+from .code_cache import CodeCache
 from .completer import PythonCompleter, create_ptpycompleter, create_ptpylexer
 from .history_browser import PythonHistory
+from .kernel import Kernel
 from .key_bindings import (
     load_confirm_exit_bindings,
     load_python_bindings,
@@ -61,7 +62,7 @@ from .key_bindings import (
 from .layout import CompletionVisualisation, PtPythonLayout
 from .prompt_style import ClassicPrompt, IPythonPrompt, PromptStyle
 from .style import generate_style, get_all_code_styles, get_all_ui_styles
-from .utils import get_jedi_script_from_document
+from .utils import get_compiler_flags, get_jedi_signatures, warm_up_jedi
 from .validator import PythonValidator
 
 __all__ = ["PythonInput"]
@@ -185,7 +186,12 @@ class PythonInput:
             create_ptpycompleter(self),
             enable_fuzzy=Condition(lambda: self.enable_fuzzy_completion),
         )
-        self._validator = _validator or PythonValidator(self.get_compiler_flags)
+        # Compiled code, shared between the validator and the REPL.
+        self.code_cache = CodeCache()
+
+        self._validator = _validator or PythonValidator(
+            self.get_compiler_flags, code_cache=self.code_cache
+        )
         self._lexer = _lexer or create_ptpylexer()
 
         self.history: History
@@ -230,6 +236,8 @@ class PythonInput:
         self.enable_syntax_highlighting: bool = True
         self.enable_fuzzy_completion: bool = False
         self.enable_dictionary_completion: bool = False
+        # Import Jedi in the background after the first prompt is drawn.
+        self.enable_jedi_warm_up: bool = True
         self.swap_light_and_dark: bool = False
         self.highlight_matching_parenthesis: bool = True
         self.show_sidebar: bool = False  # Currently show the sidebar.
@@ -296,6 +304,7 @@ class PythonInput:
         # Boolean indicating whether we have a signatures thread running.
         # (Never run more than one at the same time.)
         self._get_signatures_thread_running: bool = False
+        self._jedi_warm_up_started: bool = False
 
         # Get into Vi navigation mode at startup
         self.vi_start_in_navigation_mode: bool = False
@@ -305,6 +314,10 @@ class PythonInput:
 
         self.last_timing = None
 
+        # `Kernel` that executes the code in a child process, or `None` to
+        # execute in this process. (Only the REPL supports this.)
+        self.kernel: Optional[Kernel] = None
+
         self.style_transformation = merge_style_transformations(
             [
                 ConditionalStyleTransformation(
@@ -330,6 +343,7 @@ class PythonInput:
         )
 
         self.app = self._create_application(input, output)
+        self.app.after_render += self._start_jedi_warm_up
 
         if vi_mode:
             self.app.editing_mode = EditingMode.VI
@@ -363,23 +377,7 @@ class PythonInput:
         Give the current compiler flags by looking for _Feature instances
         in the globals.
         """
-        flags = 0
-
-        for value in self.get_globals().values():
-            try:
-                if isinstance(value, __future__._Feature):
-                    f = value.compiler_flag
-                    flags |= f
-            except BaseException:
-                # get_compiler_flags should never raise to not run into an
-                # `Unhandled exception in event loop`
-
-                # See: https://github.com/prompt-toolkit/ptpython/issues/351
-                # An exception can be raised when some objects in the globals
-                # raise an exception in a custom `__getattribute__`.
-                pass
-
-        return flags
+        return get_compiler_flags(self.get_globals())
 
     @property
     def add_key_binding(self) -> Callable[[_T], _T]:
@@ -839,36 +837,12 @@ class PythonInput:
         loop = loop or get_event_loop()
 
         def run():
-            script = get_jedi_script_from_document(
-                document, self.get_locals(), self.get_globals()
-            )
-
-            # Show signatures in help text.
-            if script:
-                try:
-                    signatures = script.call_signatures()
-                except ValueError:
-                    # e.g. in case of an invalid \\x escape.
-                    signatures = []
-                except Exception:
-                    # Sometimes we still get an exception (TypeError), because
-                    # of probably bugs in jedi. We can silence them.
-                    # See: https://github.com/davidhalter/jedi/issues/492
-                    signatures = []
-                else:
-                    # Try to access the params attribute just once. For Jedi
-                    # signatures containing the keyword-only argument star,
-                    # this will crash when retrieving it the first time with
-                    # AttributeError. Every following time it works.
-                    # See: https://github.com/jonathanslenders/ptpython/issues/47
-                    #      https://github.com/davidhalter/jedi/issues/598
-                    try:
-                        if signatures:
-                            signatures[0].params
-                    except AttributeError:
-                        pass
+            if self.kernel is not None:
+                signatures = self.kernel.get_signatures(document)
             else:
-                signatures = []
+                signatures = get_jedi_signatures(
+                    document, self.get_locals(), self.get_globals()
+                )
 
             self._get_signatures_thread_running = False
 
@@ -894,6 +868,25 @@ class PythonInput:
 
         loop.run_in_executor(None, run)
 
+    def _start_jedi_warm_up(self, app: Application) -> None:
+        """
+        After the first prompt is drawn, import Jedi and infer the builtins
+        and the global modules in a thread, to make the first completion fast.
+        """
+        if self._jedi_warm_up_started or not self.enable_jedi_warm_up:
+            return
+        self._jedi_warm_up_started = True
+
+        if self.kernel is not None:
+            return  # (The kernel does its own warm-up.)
+
+        threading.Thread(
+            target=warm_up_jedi,
+            args=(self.get_locals(), self.get_globals()),
+            name="ptpython-jedi-warm-up",
+            daemon=True,
+        ).start()
+
     def on_reset(self) -> None:
         self.signatures = []
 
@@ -9,16 +9,28 @@ Utility for creating a Python repl.
 """
 import asyncio
 import builtins
+import inspect
 import os
 import sys
 import traceback
 import warnings
 import shlex
 import pdb
-from typing import Any, Callable, ContextManager, Dict, Optional
+import queue
+import threading
+from typing import Any, Callable, ContextManager, Deque, Dict, Iterator, Optional, Tuple
 from functools import partial
+from collections import deque, namedtuple
+from itertools import chain
 import time
 
+try:
+    import contextvars
+except ImportError:
+    contextvars = None  # type: ignore  # Python 3.6.
+
+from prompt_toolkit.application import run_in_terminal
+from prompt_toolkit.application.current import get_app_or_none
 from prompt_toolkit.document import Document
 from prompt_toolkit.formatted_text import (
     FormattedText,
@@ -27,6 +39,7 @@ from prompt_toolkit.formatted_text import (
     merge_formatted_text,
     to_formatted_text,
 )
+from prompt_toolkit.formatted_text.base import StyleAndTextTuples
 from prompt_toolkit.formatted_text.utils import fragment_list_width
 from prompt_toolkit.key_binding.vi_state import InputMode
 from prompt_toolkit.patch_stdout import patch_stdout as patch_stdout_context
@@ -35,13 +48,29 @@ from prompt_toolkit.utils import DummyContext
 from pygments.lexers import PythonLexer, PythonTracebackLexer
 from pygments.token import Token
 
+from .code_cache import LAST_EXPR
 from .eventloop import inputhook
+from .jobs import Job, JobManager
+from .kernel import Kernel, KernelError
+from .layout import _format_time
 from .python_input import PythonInput
-from .formatter import PtPyFormatter
+from .formatter import FormattingCancelled, PtPyFormatter
 from .magic import MagicHandler
+from .output_history import OutputHistory
+from .pager import LazyLines, Pager
+from .user_loop import UserEventLoop
 
 __all__ = ["PythonRepl", "enable_deprecation_warnings", "run_config", "embed"]
 
+#: Timing of one executed statement. `wall` and `cpu` are in nanoseconds,
+#: `blocks` is the change in the number of allocated memory blocks.
+StatementTiming = namedtuple(
+    "StatementTiming", ("index", "source", "wall", "cpu", "blocks")
+)
+
+# Seconds before a hint is displayed while a result is being formatted.
+FORMAT_HINT_DELAY = 0.3
+
 
 class PythonRepl(PythonInput):
     def __init__(self, *a, **kw) -> None:
@@ -64,14 +93,51 @@ MptPython {self.version if self.version is not None else ''} -- A magically enha
         self.magic = MagicHandler(self)
         self.last_traceback_tokens = None
 
+        # Ring buffer with the timings of the most recent statements.
+        self.timings: Deque[StatementTiming] = deque(maxlen=1000)
+
+        # The results in `_N`, which are evicted beyond a number of results
+        # or of bytes. (See `%outmem`.)
+        self.output_history = OutputHistory(self.get_locals)
+
+        # Background jobs. When `auto_background_after` is a number of
+        # seconds, every statement runs in a worker thread, and is moved to
+        # the background when it takes longer than that.
+        self.jobs = JobManager()
+        self.auto_background_after: Optional[float] = None
+        self._finished_jobs: Deque[Job] = deque()
+        self._prompt_loop: Optional[asyncio.AbstractEventLoop] = None
+
+        # Loop for top-level `await`, shared by all statements.
+        self.user_loop = UserEventLoop()
+
+        # Limits for writing a result. (None or 0 for no limit.) What doesn't
+        # fit can be displayed with `%more`.
+        self.max_output_lines: Optional[int] = 2000
+        self.max_output_chars: Optional[int] = 1000000
+        self._more_output: Optional[Iterator[Tuple[StyleAndTextTuples, int]]] = None
+
+        # Open results that are taller than the terminal in a pager. The
+        # pager can only run after the statement, see `run_async`.
+        self.enable_pager: bool = True
+        self._pending_pager: Optional[Pager] = None
+
+        # Results are formatted in a worker thread, so that Control-C can
+        # stop the formatting. The lock is held while a chunk is formatted,
+        # because the formatter isn't thread safe. The event cancels the
+        # formatting of the last result.
+        self._format_lock = threading.Lock()
+        self._format_cancel: Optional[threading.Event] = None
+
     def debug(self):
         if getattr(sys, 'last_traceback', None):
             self.output_text( PygmentsTokens(self.last_traceback_tokens))
             self.debugger()
 
-    def output_text(self, formatted_text):
+    def output_text(self, formatted_text, end: str = "\n"):
         print_formatted_text(
             formatted_text,
+            end=end,
             style=self._current_style,
             style_transformation=self.style_transformation,
             include_default_pygments_style=False,
@@ -143,6 +209,10 @@ MptPython {self.version if self.version is not None else ''} -- A magically enha
             # Restore the original event loop.
             asyncio.set_event_loop(old_loop)
 
+            # Close the loop of the top-level `await` statements. (When `embed`
+            # returns, the program goes on.)
+            self.user_loop.close()
+
     async def run_async(self) -> None:
         if self.terminal_title:
             set_title(self.terminal_title)
@@ -160,6 +230,9 @@ MptPython {self.version if self.version is not None else ''} -- A magically enha
                 if not self.vi_keep_last_used_mode and self.vi_start_in_navigation_mode:
                     self.app.vi_state.input_mode = InputMode.NAVIGATION
 
+            self._prompt_loop = asyncio.get_event_loop()
+            self.report_finished_jobs()
+
             # Run the UI.
             try:
                 text = await self.app.run_async(pre_run=pre_run)
@@ -170,6 +243,7 @@ MptPython {self.version if self.version is not None else ''} -- A magically enha
                 self.default_buffer.document = Document()
             else:
                 self._process_text(text)
+                await self._run_pending_pager()
 
         if self.terminal_title:
             clear_title()
@@ -202,16 +276,6 @@ MptPython {self.version if self.version is not None else ''} -- A magically enha
         if "" not in sys.path:
             sys.path.insert(0, "")
 
-        def compile_with_flags(code: str, mode: str):
-            " Compile code with the right compiler flags. "
-            return compile(
-                code,
-                "<stdin>",
-                mode,
-                flags=self.get_compiler_flags(),
-                dont_inherit=True,
-            )
-
         # If the input is single line, remove leading whitespace.
         # (This doesn't have to be a syntax error.)
         if len(line.splitlines()) == 1:
@@ -226,69 +290,434 @@ MptPython {self.version if self.version is not None else ''} -- A magically enha
             os.system(line[1:])
         elif line.lstrip().startswith("%"):
             self.magic.run_command(line.lstrip()[1:])
+        elif self.kernel is not None:
+            self._execute_in_kernel(self.kernel, line)
         else:
-            # Try eval first
+            # Statements and trailing expression are compiled from a single
+            # parse. The validator usually compiled this input already.
+            body_code, expression_code = self.code_cache.compile(
+                line, "<stdin>", LAST_EXPR, self.get_compiler_flags()
+            )
+            self.output_history.use_names(
+                self.current_statement_index, body_code, expression_code
+            )
+            run = self._make_runner(body_code, expression_code)
+
+            if self.auto_background_after is not None:
+                # Run in a worker thread, and move it to the background when
+                # it takes too long.
+                job = self.start_job(line, run)
+                try:
+                    finished = job.wait(self.auto_background_after)
+                except KeyboardInterrupt:
+                    job.kill()
+                    raise
+
+                if not finished:
+                    number = self.jobs.add(job)
+                    self.output_text(FormattedText([
+                        ('class:gray', f'[{number}] Moved to the background. '
+                            f'The result will be stored in _bg{number}.'),
+                    ]))
+                    return
+
+                self.last_timing = job.wall
+                self.timings.append(StatementTiming(
+                    job.statement_index, line, job.wall, job.cpu, job.blocks
+                ))
+                if job.exception is not None:
+                    raise job.exception
+                result = job.result
+            else:
+                clock0 = time.perf_counter_ns()
+                cpu0 = time.process_time_ns()
+                blocks0 = sys.getallocatedblocks()
+                try:
+                    result = run()
+                finally:
+                    self.last_timing = time.perf_counter_ns() - clock0
+                    self.timings.append(StatementTiming(
+                        self.current_statement_index,
+                        line,
+                        self.last_timing,
+                        time.process_time_ns() - cpu0,
+                        sys.getallocatedblocks() - blocks0,
+                    ))
+
+            if expression_code is not None:
+                self.output_history.add(self.current_statement_index, result)
+
+                if result is not None:
+                    self._show_result(result)
+
+            output.flush()
+
+    def _execute_in_kernel(self, kernel: Kernel, line: str) -> None:
+        """
+        Execute the line in the kernel process, and print the result.
+        """
+        try:
+            reply = kernel.execute(
+                line,
+                self.current_statement_index,
+                self.app.output.get_size().columns,
+                (self.output_history.max_entries, self.output_history.max_bytes),
+            )
+        except KernelError as e:
+            self.print_error_message(str(e))
+            return
+
+        self.last_timing = reply.wall
+        self.timings.append(StatementTiming(
+            self.current_statement_index, line, reply.wall, reply.cpu, reply.blocks
+        ))
+
+        # (The debugger can't inspect a traceback of the kernel process.)
+        if reply.traceback is not None:
+            self._show_traceback(reply.traceback, reply.message, store_traceback=False)
+        elif reply.output is not None:
+            self._display_output(iter([(reply.output, 0)]))
+
+    def _make_runner(self, body_code, expression_code) -> Callable[[], Any]:
+        """
+        Return a callable that executes the compiled statements in the REPL
+        namespace and returns the value of the trailing expression (if any).
+        """
+        globals, locals = self.get_globals(), self.get_locals()
+
+        def run_code(code) -> Any:
+            # (`eval` also executes 'exec' code, but returns the coroutine
+            # when the code contains a top-level `await`.)
+            result = eval(code, globals, locals)
+            if code.co_flags & inspect.CO_COROUTINE:
+                result = self.user_loop.run(result)
+            return result
+
+        def run() -> Any:
+            if body_code is not None:
+                run_code(body_code)
+            if expression_code is not None:
+                return run_code(expression_code)
+            return None
+
+        return run
+
+    def start_job(self, line: str, run: Optional[Callable[[], Any]] = None) -> Job:
+        """
+        Start executing the line in a worker thread. The job is not in the
+        jobs table yet, use `self.jobs.add` for that.
+        """
+        if run is None:
+            codes = self.code_cache.compile(
+                line, "<stdin>", LAST_EXPR, self.get_compiler_flags()
+            )
+            self.output_history.use_names(self.current_statement_index, *codes)
+            run = self._make_runner(*codes)
+        job = Job(line, run, self.current_statement_index, self._job_done)
+        job.start()
+        return job
+
+    def _job_done(self, job: Job) -> None:
+        """
+        Called from the worker thread when a background job finishes.
+        """
+        # (Only jobs in the jobs table notify, so `number` is set.)
+        if job.exception is None and job.number is not None:
+            self.get_locals()["_bg%i" % job.number] = job.result
+        self.timings.append(StatementTiming(
+            job.statement_index, job.source, job.wall, job.cpu, job.blocks
+        ))
+        self._finished_jobs.append(job)
+
+        # Report it above the prompt, if the prompt is visible. Otherwise,
+        # it's reported before the next prompt is displayed.
+        if self.app.is_running and self._prompt_loop is not None:
+            self._prompt_loop.call_soon_threadsafe(
+                run_in_terminal, self.report_finished_jobs
+            )
+
+    def report_finished_jobs(self) -> None:
+        " Print a line for every background job that finished. "
+        while self._finished_jobs:
+            job = self._finished_jobs.popleft()
+            source = job.source.strip().splitlines()[0]
+            out = [
+                ('class:gray', f'[{job.number}] {job.status} after '),
+                ('class:pygments.number', _format_time(job.wall)),
+                ('class:gray', ': '),
+                ('', source),
+            ]
+            if job.status == 'failed':
+                out.append(('class:pygments.generic.error',
+                    f'\n    {type(job.exception).__name__}: {job.exception} '
+                    f'(%wait {job.number} for the traceback)'))
+            self.output_text(FormattedText(out))
+
+    def show_job(self, job: Job) -> None:
+        """
+        Display the result or the traceback of a finished job.
+        """
+        if job.status == 'killed':
+            return
+        if job.exception is not None:
             try:
-                code = compile_with_flags(line, "eval")
-                perf_counter = time.perf_counter_ns
-                clock0 = perf_counter()
-                result = eval(code, self.get_globals(), self.get_locals())
-                clock1 = perf_counter()
-                self.last_timing = clock1 - clock0
+                raise job.exception
+            except BaseException as e:
+                self.handle_exception(e)
+        elif job.result is not None:
+            self._show_result(job.result)
 
-                locals: Dict[str, Any] = self.get_locals()
-                locals["_"] = locals["_%i" % self.current_statement_index] = result
+    def _show_result(self, result: object) -> None:
+        """
+        Format the result of an expression and print it.
+        """
+        out_prompt = to_formatted_text(self.get_output_prompt())
 
-                if result is not None:
-                    out_prompt = to_formatted_text(self.get_output_prompt())
+        # The previous result is abandoned, except when it's still in the
+        # pager. (Its `%more` is replaced anyway.)
+        if self._format_cancel is not None and self._pending_pager is None:
+            self._format_cancel.set()
+        cancel = self._format_cancel = threading.Event()
+        self.formatter.width = self.app.output.get_size().columns
+
+        try:
+            # Large containers are formatted while they are written.
+            chunks = self._iter_format_in_thread(result, cancel)
+            first_chunk = next(chunks)
+        except KeyboardInterrupt:
+            self._format_interrupted(cancel, newline=False)
+            return
+        except Exception as e:
+            print(f'[TODO] Formatter exception: {e}')
+            traceback.print_exc()
+
+            try:
+                result_str = "%r\n" % (result,)
+            except UnicodeDecodeError:
+                # In Python 2: `__repr__` should return a bytestring,
+                # so to put it in a unicode context could raise an
+                # exception that the 'ascii' codec can't decode certain
+                # characters. Decode as utf-8 in that case.
+                result_str = "%s\n" % repr(result).decode(  # type: ignore
+                    "utf-8"
+                )
+
+            # Align every line to the first one.
+            line_sep = "\n" + " " * fragment_list_width(out_prompt)
+            result_str = line_sep.join(result_str.splitlines()) + "\n"
+
+            # Write output tokens.
+            if self.enable_syntax_highlighting:
+                formatted_output = merge_formatted_text(
+                    [
+                        out_prompt,
+                        PygmentsTokens(list(_lex_python_result(result_str))),
+                    ]
+                )
+            else:
+                formatted_output = FormattedText(
+                    out_prompt + [("", result_str)]
+                )
+            chunks = iter([(to_formatted_text(formatted_output), 0)])
+        else:
+            chunks = chain([first_chunk], chunks)
+
+        try:
+            self._display_output(chunks)
+        except KeyboardInterrupt:
+            self._format_interrupted(cancel)
+
+    def _format_interrupted(self, cancel: threading.Event, newline: bool = True) -> None:
+        " Control-C stops the output, but the result is kept. "
+        cancel.set()
+        self._more_output = None
+        self.output_text(FormattedText([('class:gray',
+            ('\n' if newline else '') +
+            f'Formatting interrupted. The result is stored in '
+            f'_{self.current_statement_index}.')]))
+
+    def _iter_format_in_thread(
+        self, result: object, cancel: threading.Event
+    ) -> Iterator[Tuple[StyleAndTextTuples, int]]:
+        """
+        Like `formatter.iter_format`, but format in a worker thread, a few
+        chunks ahead. When the next chunk takes a while, display a hint.
+
+        Waiting can be interrupted with Control-C, which also stops the worker
+        at the next object it formats. This iterator ends when the formatting
+        was cancelled otherwise.
+        """
+        chunk_queue: "queue.Queue" = queue.Queue(maxsize=4)
+
+        def put(item) -> bool:
+            # Give up when the consumer is gone.
+            while not cancel.is_set():
+                try:
+                    chunk_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def format_chunks() -> None:
+            chunks = self.formatter.iter_format(result, cancel)
+            while True:
+                try:
+                    with self._format_lock:
+                        chunk = next(chunks)
+                except StopIteration:
+                    put(None)
+                    return
+                except BaseException as e:
+                    put(e)
+                    return
+                if not put(chunk):
+                    return
+
+        # Copy the context: things like `numpy.set_printoptions` are context
+        # variables.
+        if contextvars is not None:
+            target: Callable[..., None] = contextvars.copy_context().run
+            args: Tuple = (format_chunks,)
+        else:
+            target, args = format_chunks, ()
+
+        threading.Thread(
+            target=target, args=args, name="ptpython-format", daemon=True
+        ).start()
+
+        # (Not while the pager is running, it draws the full screen.)
+        app = get_app_or_none()
+        show_hint = app is None or not app.is_running
+        hint = 'Formatting the result... (Control-C to stop)'
+        hint_shown = False
+        try:
+            while True:
+                deadline = time.monotonic() + FORMAT_HINT_DELAY
+                while True:
                     try:
-                        formatted_output = self.formatter.format(result)
-                    except Exception as e:
-                        print(f'[TODO] Formatter exception: {e}')
-                        traceback.print_exc()
-
-                        try:
-                            result_str = "%r\n" % (result,)
-                        except UnicodeDecodeError:
-                            # In Python 2: `__repr__` should return a bytestring,
-                            # so to put it in a unicode context could raise an
-                            # exception that the 'ascii' codec can't decode certain
-                            # characters. Decode as utf-8 in that case.
-                            result_str = "%s\n" % repr(result).decode(  # type: ignore
-                                "utf-8"
-                            )
-
-                        # Align every line to the first one.
-                        line_sep = "\n" + " " * fragment_list_width(out_prompt)
-                        result_str = line_sep.join(result_str.splitlines()) + "\n"
-
-                        # Write output tokens.
-                        if self.enable_syntax_highlighting:
-                            formatted_output = merge_formatted_text(
-                                [
-                                    out_prompt,
-                                    PygmentsTokens(list(_lex_python_result(result_str))),
-                                ]
-                            )
-                        else:
-                            formatted_output = FormattedText(
-                                out_prompt + [("", result_str)]
-                            )
-
-                    self.output_text(formatted_output)
-
-            # If not a valid `eval` expression, run using `exec` instead.
-            except SyntaxError:
-                code = compile_with_flags(line, "exec")
-                perf_counter = time.perf_counter_ns
-                clock0 = perf_counter()
-                exec(code, self.get_globals(), self.get_locals())
-                clock1 = perf_counter()
-                self.last_timing = clock1 - clock0
+                        item = chunk_queue.get(timeout=0.05)
+                        break
+                    except queue.Empty:
+                        if show_hint and not hint_shown and time.monotonic() > deadline:
+                            self.output_text(FormattedText([('class:gray', hint)]), end="")
+                            self.app.output.flush()
+                            hint_shown = True
+
+                if hint_shown:
+                    self._erase_format_hint(len(hint))
+                    hint_shown = False
+
+                if item is None or isinstance(item, FormattingCancelled):
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        except KeyboardInterrupt:
+            if hint_shown:
+                self._erase_format_hint(len(hint))
+            raise
+        finally:
+            cancel.set()
 
-            output.flush()
+    def _erase_format_hint(self, width: int) -> None:
+        # Move back instead of to the start of the line: part of the result
+        # can be written already.
+        output = self.app.output
+        output.cursor_backward(width)
+        output.erase_end_of_line()
+        output.flush()
+
+    def _display_output(self, chunks: Iterator[Tuple[StyleAndTextTuples, int]]) -> None:
+        """
+        Write the chunks of a result, or, if it's taller than the terminal,
+        prepare the pager for it. Only the first screen of the result is
+        formatted here.
+        """
+        if self.enable_pager and not self.app.is_running and self._output_is_tty():
+            size = self.app.output.get_size()
+            lines = LazyLines(chunks, size.columns)
+            if lines.ensure(size.rows) >= size.rows:
+                self._pending_pager = Pager(self, lines)
+                return
+            chunks = iter([(lines.to_formatted_text(), 0)])
+
+        self._write_output(chunks)
+
+    def _output_is_tty(self) -> bool:
+        try:
+            return os.isatty(self.app.output.fileno())
+        except Exception:
+            return False
+
+    async def _run_pending_pager(self) -> None:
+        " Open the pager that `_display_output` prepared, if any. "
+        pager, self._pending_pager = self._pending_pager, None
+        if pager is not None:
+            await pager.app.run_async()
+            self.output_text(FormattedText([('class:gray',
+                f'(Result displayed in the pager, {len(pager.lines.rows)} lines formatted.)')]))
+
+    def _write_output(self, chunks: Iterator[Tuple[StyleAndTextTuples, int]]) -> None:
+        """
+        Write the `(fragments, remaining_items)` chunks of a result, until
+        `max_output_lines` or `max_output_chars` is reached. The rest is kept
+        for `%more`.
+        """
+        self._more_output = None
+        lines_left = self.max_output_lines or sys.maxsize
+        chars_left = self.max_output_chars or sys.maxsize
+
+        batch: StyleAndTextTuples = []
+        batch_size = 0
+        flush_time = time.monotonic() + FORMAT_HINT_DELAY
+
+        for fragments, remaining in chunks:
+            for i, (style, text, *_) in enumerate(fragments):
+                lines = text.count("\n")
+                if lines >= lines_left or len(text) > chars_left:
+                    # Budget exhausted: cut this fragment and keep the rest.
+                    cut = chars_left
+                    if lines >= lines_left:
+                        cut = min(cut, _find_nth(text, "\n", lines_left))
+                    batch.append((style, text[:cut]))
+                    if text[cut:cut + 1] == "\n":
+                        cut += 1  # This line break is written after the batch.
+                    rest = [(style, text[cut:])] + list(fragments[i + 1:])
+                    self._more_output = _skip_empty_output(
+                        chain([(rest, remaining)], chunks))
+
+                    self.output_text(FormattedText(batch))
+                    if self._more_output is not None:
+                        self.output_text(FormattedText([('class:gray',
+                            f'… {remaining} more items (use %more)' if remaining
+                            else '… output truncated (use %more)')]))
+                    return
+
+                lines_left -= lines
+                chars_left -= len(text)
+                batch.append((style, text))
+                batch_size += len(text)
+
+            # Write in chunks of reasonable size, or what we have when
+            # formatting is slow.
+            if batch_size > 64 * 1024 or (batch and time.monotonic() > flush_time):
+                self.output_text(FormattedText(batch), end="")
+                self.app.output.flush()
+                batch = []
+                batch_size = 0
+                flush_time = time.monotonic() + FORMAT_HINT_DELAY
+
+        self.output_text(FormattedText(batch))
+
+    def show_more(self) -> None:
+        " Continue writing the output that was truncated. "
+        if self._more_output is None:
+            self.print_error_message('No more output')
+        else:
+            self._write_output(self._more_output)
 
-    def handle_exception(self, e: Exception, store_traceback=True) -> None:
+    def handle_exception(self, e: BaseException, store_traceback=True) -> None:
         output = self.app.output
 
         # Instead of just calling ``traceback.format_exc``, we take the
@@ -299,20 +728,11 @@ MptPython {self.version if self.version is not None else ''} -- A magically enha
         if store_traceback:
             sys.last_type, sys.last_value, sys.last_traceback = t, v, tb
 
-        tblist = list(traceback.extract_tb(tb))
-
-        for line_nr, tb_tuple in enumerate(tblist):
-            if tb_tuple[0] == "<stdin>":
-                tblist = tblist[line_nr:]
-                break
-
-        l = traceback.format_list(tblist)
-        if l:
-            l.insert(0, "Traceback (most recent call last):\n")
-        l.extend(traceback.format_exception_only(t, v))
-
-        tb_str = "".join(l)
+        tb_str = format_traceback(t, v, tb)
+        self._show_traceback(tb_str, f'Stopped for exception: {e}', store_traceback)
+        output.flush()
 
+    def _show_traceback(self, tb_str: str, message: str, store_traceback=True) -> None:
         # Format exception and write to output.
         # (We use the default style. Most other styles result
         # in unreadable colors for the traceback.)
@@ -326,8 +746,7 @@ MptPython {self.version if self.version is not None else ''} -- A magically enha
 
         self.output_text(PygmentsTokens(tokens))
 
-        self.print_error_message(f'Stopped for exception: {e}')
-        output.flush()
+        self.print_error_message(message)
 
     def _handle_keyboard_interrupt(self, e: KeyboardInterrupt) -> None:
         output = self.app.output
@@ -339,6 +758,46 @@ MptPython {self.version if self.version is not None else ''} -- A magically enha
         self.output_text(FormattedText([('class:pygments.generic.error', msg)]),)
 
 
+def _skip_empty_output(
+    chunks: Iterator[Tuple[StyleAndTextTuples, int]]
+) -> Optional[Iterator[Tuple[StyleAndTextTuples, int]]]:
+    """
+    Return the chunks from the first one that contains text, or `None` when
+    there is no more text. (The chunks are formatted until then.)
+    """
+    for fragments, remaining in chunks:
+        if any(text for _, text, *_ in fragments):
+            return chain([(fragments, remaining)], chunks)
+    return None
+
+
+def _find_nth(text: str, sub: str, n: int) -> int:
+    " Index of the `n`-th occurrence of `sub` in `text`. "
+    index = -1
+    for _ in range(n):
+        index = text.find(sub, index + 1)
+    return index
+
+
+def format_traceback(t, v, tb) -> str:
+    """
+    Format the exception, but skip the bottom calls of this framework.
+    """
+    tblist = list(traceback.extract_tb(tb))
+
+    for line_nr, tb_tuple in enumerate(tblist):
+        if tb_tuple[0] == "<stdin>":
+            tblist = tblist[line_nr:]
+            break
+
+    l = traceback.format_list(tblist)
+    if l:
+        l.insert(0, "Traceback (most recent call last):\n")
+    l.extend(traceback.format_exception_only(t, v))
+
+    return "".join(l)
+
+
 def _lex_python_traceback(tb):
     " Return token list for traceback string. "
     lexer = PythonTracebackLexer()
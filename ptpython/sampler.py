@@ -0,0 +1,231 @@
+"""
+Sampling profiler for REPL statements.
+
+A background thread looks at the stack of the profiled thread a few hundred
+times per second, using `sys._current_frames()`. Unlike `cProfile`, this
+doesn't slow down the code that is measured, so tight loops keep their
+real-world timing. The stacks are aggregated in the collapsed-stack format
+of Brendan Gregg's flamegraph tools, and can be written as a folded file or
+as a self-contained SVG flamegraph.
+
+::
+
+    %sample -o profile.svg main()
+"""
+import os
+import sys
+import threading
+from collections import Counter
+from html import escape
+from types import FrameType
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+from zlib import crc32
+
+__all__ = ["Sampler"]
+
+
+class Sampler:
+    """
+    Collect the stacks of some threads, until `stop` is called.
+
+    :param rate: Samples per second. (Note that the sampling thread needs the
+        GIL, so for CPU bound code, the real rate is limited by
+        `sys.getswitchinterval()`.)
+    :param thread_ids: Threads to sample. `None` for all threads.
+    :param root: Code object of the function where the interesting part of
+        the stacks starts. The frames above it are left out, and stacks that
+        don't contain it (before and after the call) aren't recorded.
+    :param root_thread_id: The thread that calls `root`. If given, the stacks
+        of the other threads are recorded as a whole.
+    :param filename: When a stack contains code from this file (like
+        '<stdin>'), the frames above the first of those are left out too.
+    """
+
+    def __init__(
+        self,
+        rate: float = 200,
+        thread_ids: Optional[Set[int]] = None,
+        root=None,
+        root_thread_id: Optional[int] = None,
+        filename: Optional[str] = None,
+    ) -> None:
+        self.rate = rate
+        self.thread_ids = thread_ids
+        self.root = root
+        self.root_thread_id = root_thread_id
+        self.filename = filename
+
+        #: Number of samples for each stack, root first. Frames are
+        #: identified by their code object, which is cheap to hash.
+        self.stacks: Counter = Counter()
+        self.sample_count = 0
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="ptpython-sampler", daemon=True
+        )
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self) -> "Sampler":
+        self.start()
+        return self
+
+    def __exit__(self, *a) -> None:
+        self.stop()
+
+    def _run(self) -> None:
+        interval = 1 / self.rate
+        own_id = threading.get_ident()
+
+        while not self._stop.wait(interval):
+            for thread_id, top in sys._current_frames().items():
+                if thread_id == own_id or (
+                    self.thread_ids is not None and thread_id not in self.thread_ids
+                ):
+                    continue
+                stack = []
+                frame: Optional[FrameType] = top
+                while frame is not None and frame.f_code is not self.root:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                if (
+                    frame is None
+                    and self.root is not None
+                    and self.root_thread_id in (None, thread_id)
+                ):
+                    continue  # Not in `root`, like in `stop`.
+                stack.reverse()
+                self.stacks[tuple(stack)] += 1
+            self.sample_count += 1
+
+    def _trim(self, stack: Tuple) -> Tuple:
+        " Apply `filename`. (Not while sampling, to keep that cheap.) "
+        for i, code in enumerate(stack):
+            if code.co_filename == self.filename:
+                return stack[i:]
+        return stack
+
+    def folded(self) -> Iterator[str]:
+        " Lines of the collapsed-stack format: 'root;...;leaf count'. "
+        for stack, count in self.stacks.items():
+            yield "%s %i" % (";".join(_frame_name(c) for c in self._trim(stack)), count)
+
+    def top_of_stack(self) -> List[Tuple[str, int, int]]:
+        """
+        For every function: `(name, self samples, total samples)`, sorted by
+        the samples in that function itself.
+        """
+        own: Counter = Counter()
+        total: Counter = Counter()
+        for stack, count in self.stacks.items():
+            stack = self._trim(stack)
+            if stack:
+                own[stack[-1]] += count
+            for code in set(stack):
+                total[code] += count
+        return [
+            (_frame_name(code), count, total[code]) for code, count in own.most_common()
+        ]
+
+    def write_folded(self, filename: str) -> None:
+        with open(filename, "w") as f:
+            for line in self.folded():
+                f.write(line + "\n")
+
+    def write_svg(self, filename: str, title: str = "Flame Graph") -> None:
+        with open(filename, "w") as f:
+            f.write(flamegraph_svg(self.folded(), title))
+
+
+def _frame_name(code) -> str:
+    name = getattr(code, "co_qualname", code.co_name)
+    return "%s (%s:%i)" % (
+        name,
+        os.path.basename(code.co_filename),
+        code.co_firstlineno,
+    )
+
+
+def flamegraph_svg(folded_lines: Iterator[str], title: str = "Flame Graph") -> str:
+    """
+    Render collapsed stacks as an SVG flamegraph, without external tools.
+    The tooltip of every frame tells the number of samples.
+    """
+    # Merge the stacks into a tree: name -> [count, children].
+    Node = Dict[str, list]
+    root: Node = {}
+    total = 0
+    for line in folded_lines:
+        stack, _, count_str = line.rpartition(" ")
+        count = int(count_str)
+        total += count
+        children = root
+        for name in stack.split(";") if stack else []:
+            node = children.setdefault(name, [0, {}])
+            node[0] += count
+            children = node[1]
+
+    width, frame_height, font_size, top = 1200, 16, 11, 34
+    scale = (width - 20) / max(total, 1)
+
+    rects: List[str] = []
+    max_depth = 0
+
+    def add(children: Node, x: float, depth: int) -> None:
+        nonlocal max_depth
+        for name, (count, grand_children) in sorted(children.items()):
+            w = count * scale
+            if w >= 0.5:
+                max_depth = max(max_depth, depth)
+                rects.append(_svg_frame(name, count, total, x, depth, w))
+                add(grand_children, x, depth + 1)
+            x += w
+
+    add(root, 10, 0)
+
+    y_flip = top + (max_depth + 1) * frame_height
+    height = y_flip + 10
+    return "\n".join(
+        [
+            '<?xml version="1.0" standalone="no"?>',
+            f'<svg version="1.1" width="{width}" height="{height}" '
+            f'viewBox="0 0 {width} {height}" xmlns="http://www.w3.org/2000/svg">',
+            f"<style>text {{ font-family: Verdana, sans-serif; font-size: {font_size}px; }}</style>",
+            f'<rect x="0" y="0" width="{width}" height="{height}" fill="#eeeeee"/>',
+            f'<text x="{width // 2}" y="20" text-anchor="middle">{escape(title)}'
+            f" ({total} samples)</text>",
+            f'<g transform="translate(0, {y_flip}) scale(1, -1)">',
+        ]
+        + rects
+        + ["</g>", "</svg>", ""]
+    )
+
+
+def _svg_frame(
+    name: str, count: int, total: int, x: float, depth: int, w: float
+) -> str:
+    # Warm colors, stable for every name.
+    h = crc32(name.encode("utf-8"))
+    color = "rgb(%i,%i,%i)" % (205 + h % 50, 80 + (h >> 8) % 130, (h >> 16) % 55)
+
+    y = depth * 16
+    label = (
+        name if len(name) * 7 < w - 6 else name[: max(int((w - 6) / 7) - 2, 0)] + ".."
+    )
+    if w < 21:
+        label = ""
+    tooltip = "%s (%i samples, %.2f%%)" % (name, count, 100 * count / total)
+
+    # The group is mirrored, so that the stacks grow upwards; mirror the
+    # text back.
+    return (
+        f"<g><title>{escape(tooltip)}</title>"
+        f'<rect x="{x:.1f}" y="{y}" width="{w:.1f}" height="15" fill="{color}" rx="2"/>'
+        f'<text x="{x + 3:.1f}" y="{-y - 4}" transform="scale(1, -1)">{escape(label)}</text></g>'
+    )
@@ -0,0 +1,64 @@
+"""
+Event loop for running top-level `await` statements from the REPL.
+
+The loop lives as long as the REPL, in a dedicated thread, so that resources
+that are bound to a loop (like aiohttp sessions or asyncpg connection pools)
+can be reused across statements. The prompt runs in a different loop, so a
+coroutine that never yields can't freeze the prompt itself.
+"""
+import asyncio
+import threading
+from typing import Any, Coroutine, Optional
+
+__all__ = ["UserEventLoop"]
+
+
+class UserEventLoop:
+    """
+    Asyncio event loop in a daemon thread. The thread is started when the
+    first coroutine is executed.
+    """
+
+    def __init__(self) -> None:
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self._run_forever,
+                    args=(self._loop,),
+                    name="ptpython-user-loop",
+                    daemon=True,
+                ).start()
+            return self._loop
+
+    @staticmethod
+    def _run_forever(loop: asyncio.AbstractEventLoop) -> None:
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+
+    def run(self, coroutine: Coroutine[Any, Any, Any]) -> Any:
+        """
+        Run the coroutine in the user loop and wait for the result. On
+        Ctrl-C, the task is cancelled.
+        """
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        try:
+            return future.result()
+        except KeyboardInterrupt:
+            future.cancel()
+            raise
+
+    def close(self) -> None:
+        " Stop the loop. A new one is created for the next coroutine. "
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
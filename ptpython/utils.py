@@ -1,14 +1,21 @@
 """
 For internal use only.
 """
+import __future__
+import ast
 import re
+import types
 from typing import Callable, TypeVar, cast
 
+from prompt_toolkit.document import Document
 from prompt_toolkit.mouse_events import MouseEvent, MouseEventType
 
 __all__ = [
     "has_unclosed_brackets",
     "get_jedi_script_from_document",
+    "get_jedi_signatures",
+    "warm_up_jedi",
+    "get_compiler_flags",
     "document_is_multiline_python",
 ]
 
@@ -74,6 +81,89 @@ def get_jedi_script_from_document(document, locals, globals):
         return None
 
 
+# Number of modules in the namespace that `warm_up_jedi` completes.
+WARM_UP_MODULE_COUNT = 20
+
+
+def warm_up_jedi(locals, globals) -> None:
+    """
+    Import Jedi and let it infer the builtins and the modules in the
+    namespace, so that the first completion doesn't have to. (This takes a
+    second or more, so it's meant to run in a background thread.)
+    """
+    module_names = [
+        name
+        for name, value in list(globals.items())
+        if isinstance(value, types.ModuleType) and name.isidentifier()
+    ]
+    for text in [""] + [name + "." for name in module_names[:WARM_UP_MODULE_COUNT]]:
+        script = get_jedi_script_from_document(Document(text), locals, globals)
+        if script:
+            try:
+                script.completions()
+            except Exception:
+                pass  # Jedi bugs. (Like in `PythonCompleter`.)
+
+
+def get_jedi_signatures(document, locals, globals):
+    """
+    Return the Jedi call signatures at the cursor position.
+    """
+    script = get_jedi_script_from_document(document, locals, globals)
+
+    if not script:
+        return []
+
+    try:
+        signatures = script.call_signatures()
+    except ValueError:
+        # e.g. in case of an invalid \\x escape.
+        signatures = []
+    except Exception:
+        # Sometimes we still get an exception (TypeError), because
+        # of probably bugs in jedi. We can silence them.
+        # See: https://github.com/davidhalter/jedi/issues/492
+        signatures = []
+    else:
+        # Try to access the params attribute just once. For Jedi
+        # signatures containing the keyword-only argument star,
+        # this will crash when retrieving it the first time with
+        # AttributeError. Every following time it works.
+        # See: https://github.com/jonathanslenders/ptpython/issues/47
+        #      https://github.com/davidhalter/jedi/issues/598
+        try:
+            if signatures:
+                signatures[0].params
+        except AttributeError:
+            pass
+    return signatures
+
+
+def get_compiler_flags(globals) -> int:
+    """
+    Give the compiler flags for this namespace, by looking for _Feature
+    instances in the globals.
+    """
+    # Allow `await` at the prompt. (Python 3.8+)
+    flags = getattr(ast, "PyCF_ALLOW_TOP_LEVEL_AWAIT", 0)
+
+    for value in globals.values():
+        try:
+            if isinstance(value, __future__._Feature):
+                f = value.compiler_flag
+                flags |= f
+        except BaseException:
+            # get_compiler_flags should never raise to not run into an
+            # `Unhandled exception in event loop`
+
+            # See: https://github.com/prompt-toolkit/ptpython/issues/351
+            # An exception can be raised when some objects in the globals
+            # raise an exception in a custom `__getattribute__`.
+            pass
+
+    return flags
+
+
 _multiline_string_delims = re.compile("""[']{3}|["]{3}""")
 
 
@@ -1,5 +1,7 @@
 from prompt_toolkit.validation import ValidationError, Validator
 
+from .code_cache import LAST_EXPR, CodeCache
+
 __all__ = ["PythonValidator"]
 
 
@@ -9,10 +11,13 @@ class PythonValidator(Validator):
 
     :param get_compiler_flags: Callable that returns the currently
         active compiler flags.
+    :param code_cache: `CodeCache` instance. When shared with the REPL, the
+        code that was compiled for validation is reused for execution.
     """
 
-    def __init__(self, get_compiler_flags=None):
+    def __init__(self, get_compiler_flags=None, code_cache=None):
         self.get_compiler_flags = get_compiler_flags
+        self.code_cache = code_cache or CodeCache()
 
     def validate(self, document):
         """
@@ -36,7 +41,9 @@ class PythonValidator(Validator):
             else:
                 flags = 0
 
-            compile(text, "<input>", "exec", flags=flags, dont_inherit=True)
+            # Compile the way the REPL does, so that it can take the code
+            # objects from the cache.
+            self.code_cache.compile(text, "<stdin>", LAST_EXPR, flags)
         except SyntaxError as e:
             # Note, the 'or 1' for offset is required because Python 2.7
             # gives `None` as offset in case of '4=4' as input. (Looks like
@@ -1,22 +1,61 @@
 #!/usr/bin/env python
 import unittest
 
+from prompt_toolkit.completion import CompleteEvent
+from prompt_toolkit.document import Document
+from prompt_toolkit.input import create_pipe_input
+from prompt_toolkit.output import DummyOutput
+
+import ptpython.code_cache
 import ptpython.completer
 import ptpython.eventloop
 import ptpython.filters
 import ptpython.history_browser
+import ptpython.jobs
+import ptpython.kernel
 import ptpython.key_bindings
 import ptpython.layout
+import ptpython.output_history
+import ptpython.pager
 import ptpython.python_input
 import ptpython.repl
+import ptpython.sampler
 import ptpython.style
+import ptpython.user_loop
 import ptpython.utils
 import ptpython.validator
 
-# For now there are no tests here.
+# Apart from the smoke tests below, there are no tests here.
 # However this is sufficient for Travis to do at least a syntax check.
 # That way we are at least sure to restrict to the Python 2.6 syntax.
 
 
+class ConstructionTest(unittest.TestCase):
+    def test_completer(self):
+        namespace = {"variable": 1}
+        completer = ptpython.completer.PythonCompleter(
+            lambda: namespace, lambda: namespace, lambda: True
+        )
+        completions = completer.get_completions(
+            Document("varia"), CompleteEvent(completion_requested=True)
+        )
+        self.assertIn("variable", [c.text for c in completions])
+
+    def test_repl(self):
+        namespace = {"variable": 1}
+        input = create_pipe_input()
+        try:
+            repl = ptpython.repl.PythonRepl(
+                get_globals=lambda: namespace, input=input, output=DummyOutput()
+            )
+        finally:
+            input.close()
+
+        completions = repl._completer.get_completions(
+            Document("varia"), CompleteEvent(completion_requested=True)
+        )
+        self.assertIn("variable", [c.text for c in completions])
+
+
 if __name__ == "__main__":
     unittest.main()